@@ -1,7 +1,10 @@
 from blspy import G1Element, G2Element, AugSchemeMPL
 from zellular import Zellular, get_operators
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from threading import Lock
 import requests
 import time
+import heapq
 import base64
 import json
 
@@ -11,6 +14,15 @@ BASE_URLS = [op["socket"] for op in OPERATORS.values() if "socket" in op]
 APP_NAME = "avs-downtime-monitor"
 zellular = Zellular(APP_NAME, BASE_URLS[0])
 THRESHOLD = 2  # Minimum number of valid signatures required
+COLLECT_DEADLINE = 5  # Seconds a signature collection round may take
+CHECK_TIMEOUT = 3  # Seconds a single /check_node request may take
+PROBE_INTERVAL = 1.0  # Seconds between status probes of a healthy node
+SUSPECT_INTERVAL = 0.2  # Seconds between probes of a node whose last probe failed
+PROBE_TIMEOUT = 0.5  # Seconds before a status probe counts as down
+PROBE_WORKERS = 64  # Probes that may be in flight at once
+REPORT_INTERVAL = 30  # Seconds between probe latency reports
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)  # Histogram upper bounds, in seconds
+DOWN_EVENT_SPAN = 30  # Seconds of downtime one proof stands for, a node that stays down is reported once per span
 
 # Hardcoded operator details
 OPERATORS = {
@@ -43,31 +55,69 @@ URLMAP = {
 
 
 # Query a node's status
-def query_node_status(node_url):
+def query_node_status(node_url, session=requests, timeout=PROBE_TIMEOUT):
     try:
-        response = requests.get(f"{node_url}/status")
+        response = session.get(f"{node_url}/status", timeout=timeout)
         return response.json()
     except Exception as e:
-        return {"node_id": node_url, "status": "down", "timestamp": int(time.time())}
+        return {"node_id": URLMAP.get(node_url, node_url), "status": "down", "timestamp": int(time.time())}
 
-# Collect signatures from other operators
-def collect_signatures(target_node_url):
+# Latest /check_node round-trip per operator URL, in seconds
+operator_latency = {}
+
+
+# Ask one operator to check the target and return its signed status
+def request_signature(operator_url, target_node_url):
+    start_time = time.time()
+    try:
+        response = requests.post(
+            f"{operator_url}/check_node",
+            json={"node_id": URLMAP.get(target_node_url, target_node_url), "node_url": target_node_url},
+            timeout=CHECK_TIMEOUT,
+        )
+    finally:
+        operator_latency[operator_url] = time.time() - start_time
+    if response.status_code != 200:
+        raise ValueError(f"status code {response.status_code}")
+    signature = response.json()
+    # Only a well-formed signature over a down status counts towards the threshold
+    if signature.get('status') != 'down':
+        raise ValueError(f"operator sees the node as {signature.get('status')}")
+    G2Element.from_bytes(base64.b64decode(signature['signature']))
+    return signature
+
+
+# Collect signatures from other operators in parallel, stopping at THRESHOLD or the deadline
+def collect_signatures(target_node_url, deadline=COLLECT_DEADLINE):
     signatures = []
-    non_signers = []
-    for operator_url in BASE_URLS:
-        if operator_url != target_node_url:
+    signers = set()
+    peers = [operator_url for operator_url in BASE_URLS if operator_url != target_node_url]
+    if not peers:
+        return signatures, list(OPERATORS)
+    executor = ThreadPoolExecutor(max_workers=len(peers))
+    futures = {executor.submit(request_signature, operator_url, target_node_url): operator_url for operator_url in peers}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            operator_url = futures[future]
             try:
-                response = requests.post(
-                    f"{operator_url}/check_node",
-                    json={"node_id": URLMAP[target_node_url]}
-                )
-                if response.status_code == 200:
-                    signatures.append(response.json())
-                    
+                signatures.append(future.result())
+                signers.add(operator_url)
             except Exception as e:
-                non_signers.append(URLMAP[target_node_url])
                 print(f"Error requesting from {operator_url}: {e}")
-    return signatures,non_signers
+            if len(signatures) >= THRESHOLD:
+                break
+    except TimeoutError:
+        print(f"Signature collection for {target_node_url} hit the {deadline}s deadline")
+    finally:
+        # Don't wait for stragglers, the quorum (or the deadline) decides
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    latencies = ', '.join(f"{url}={operator_latency[url] * 1000:.0f}ms" for url in peers if url in operator_latency)
+    print(f"Collected {len(signatures)} signatures for {target_node_url} ({latencies})")
+    # Every registry operator that didn't sign, including the target itself, so verifiers
+    # aggregate exactly the signers' keys
+    non_signers = [operator_id for operator_id, operator in OPERATORS.items() if operator.get("socket") not in signers]
+    return signatures, non_signers
 
 # Aggregate BLS signatures
 def aggregate_signatures(signatures):
@@ -83,24 +133,118 @@ def submit_to_sequencer(event):
     except Exception as e:
         print(f"Error submitting event to sequencer: {e}")
 
+# Collect proofs for a node that looks down and submit the event, True if it was submitted
+def report_downtime(node_url, target_status):
+    print(f"Node {target_status['node_id']} is down. Collecting proofs...")
+    signatures, non_signers = collect_signatures(node_url)
+    if len(signatures) >= THRESHOLD:
+        agg_sig = aggregate_signatures(signatures)
+        event = {
+            "node_id": target_status["node_id"],
+            "status": "down",
+            "timestamp": target_status["timestamp"],
+            "aggregated_signature": base64.b64encode(bytes(agg_sig)).decode('utf-8'),
+            "non_signers" : non_signers,
+        }
+        submit_to_sequencer(event)
+        return True
+    return False
+
+
+# Probes every operator on its own staggered timer over a keep-alive session,
+# probing suspect nodes more often and keeping a latency histogram per node
+class ProbeScheduler:
+    def __init__(self, node_urls):
+        self.node_urls = node_urls
+        self.sessions = {node_url: requests.Session() for node_url in node_urls}
+        self.histograms = {node_url: [0] * (len(LATENCY_BUCKETS) + 1) for node_url in node_urls}
+        self.suspects = set()
+        self.in_flight = set()
+        self.reporting = set()
+        self.reported_at = {}  # node url -> when its current outage was last reported
+        self.lock = Lock()
+        self.probes = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+        self.reporters = ThreadPoolExecutor(max_workers=max(len(node_urls), 1))
+
+    def _record_latency(self, node_url, latency):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            self.histograms[node_url][bucket] += 1
+
+    def probe(self, node_url):
+        start_time = time.time()
+        try:
+            target_status = query_node_status(node_url, session=self.sessions[node_url])
+        finally:
+            self._record_latency(node_url, time.time() - start_time)
+            with self.lock:
+                self.in_flight.discard(node_url)
+
+        with self.lock:
+            if target_status['status'] != 'down':
+                self.suspects.discard(node_url)
+                # A new outage is reported right away
+                self.reported_at.pop(node_url, None)
+                return
+            self.suspects.add(node_url)
+            # One proof collection per node at a time, later probes keep it suspect
+            if node_url in self.reporting:
+                return
+            # A node that stays down is reported again once the last proof's span is over
+            if time.time() - self.reported_at.get(node_url, 0) < DOWN_EVENT_SPAN:
+                return
+            self.reporting.add(node_url)
+        self.reporters.submit(self._report, node_url, target_status)
+
+    def _report(self, node_url, target_status):
+        try:
+            if report_downtime(node_url, target_status):
+                with self.lock:
+                    # Unless the node came back meanwhile, its next outage starts fresh then
+                    if node_url in self.suspects:
+                        self.reported_at[node_url] = time.time()
+        except Exception as e:
+            print(f"Error reporting downtime of {node_url}: {e}")
+        finally:
+            with self.lock:
+                self.reporting.discard(node_url)
+
+    def latency_report(self):
+        labels = [f"<={bound * 1000:g}ms" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1] * 1000:g}ms"]
+        with self.lock:
+            lines = []
+            for node_url, counts in self.histograms.items():
+                histogram = ' '.join(f"{label}:{count}" for label, count in zip(labels, counts) if count)
+                lines.append(f"{node_url}{' (suspect)' if node_url in self.suspects else ''} {histogram}")
+        return '\n'.join(lines)
+
+    def run(self):
+        now = time.time()
+        # Spread the first probes over one interval so nodes aren't all hit at once
+        timers = [(now + i * PROBE_INTERVAL / len(self.node_urls), node_url) for i, node_url in enumerate(self.node_urls)]
+        heapq.heapify(timers)
+        next_report = now + REPORT_INTERVAL
+        while timers:
+            due, node_url = heapq.heappop(timers)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                busy = node_url in self.in_flight
+                self.in_flight.add(node_url)
+                interval = SUSPECT_INTERVAL if node_url in self.suspects else PROBE_INTERVAL
+            if not busy:
+                self.probes.submit(self.probe, node_url)
+            heapq.heappush(timers, (max(due + interval, time.time()), node_url))
+
+            if time.time() >= next_report:
+                print(f"Probe latency histograms:\n{self.latency_report()}")
+                next_report += REPORT_INTERVAL
+
+
 # main
 def main():
-    for operator_url in BASE_URLS:
-        if (target_status:=query_node_status(operator_url)['status']) == 'down':
-            print(f"Node {target_status['node_id']} is down. Collecting proofs...")
-            signatures,non_signers = collect_signatures(operator_url)
-            if len(signatures) >= THRESHOLD:
-                agg_sig = aggregate_signatures(signatures)
-                event = {
-                    "node_id": target_status["node_id"],
-                    "status": "down",
-                    "timestamp": target_status["timestamp"],
-                    "aggregated_signature": base64.b64encode(bytes(agg_sig)).decode('utf-8'),
-                    "non_signers" : non_signers,
-                }
-                submit_to_sequencer(event)
+    ProbeScheduler(BASE_URLS).run()
 
 if __name__ == "__main__":
-    while True:
-        main()
-        time.sleep(30)
\ No newline at end of file
+    main()
@@ -1,4 +1,5 @@
 import sys
+import os
 from flask import Flask, request, jsonify
 from blspy import PrivateKey, AugSchemeMPL, G2Element,G1Element
 from zellular import Zellular, get_operators
@@ -7,7 +8,14 @@ import base64
 import time
 import json
 import requests
-from threading import Thread
+import asyncio
+from threading import Thread, Lock, local
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# The pipelined batch consumer is shared by the apps and lives at the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from batch_consumer import BatchConsumer, load_batch
 
 app = Flask(__name__)
 
@@ -56,39 +64,120 @@ ZELLULAR_OPERATORS = get_operators()
 BASE_URLS = [op["socket"] for op in ZELLULAR_OPERATORS.values() if "socket" in op]
 
 zellular = Zellular(APP_NAME, BASE_URLS[0])
+AGGREGATE_KEY_CACHE_SIZE = 1024  # Non-signer sets whose aggregate key is kept
+DOWN_EVENT_SPAN = 30  # Seconds of downtime a single down proof stands for
+ROLLUP_BUCKET = 60  # Seconds per down-count rollup bucket, query buckets are multiples of it
+CHECK_CACHE_TTL = float(os.environ.get('CHECK_CACHE_TTL', 2))  # Seconds a signed probe result is reused
+CHECK_TIMEOUT = 3  # Seconds before a probed node counts as down
+
+# Single long-lived connection shared by the sequencer reader
+db_conn = None
+db_lock = Lock()
+
+
+# Open (once) the connection in WAL mode with explicit transaction control
+def get_db():
+    global db_conn
+    if db_conn is None:
+        db_conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None)
+        db_conn.execute('PRAGMA journal_mode=WAL')
+        db_conn.execute('PRAGMA synchronous=NORMAL')
+    return db_conn
+
 
 # Initialize the SQLite database
 def init_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            node_id TEXT NOT NULL,
-            status TEXT NOT NULL,
-            timestamp INTEGER NOT NULL,
-            signature TEXT NOT NULL,
-            non_signers TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-# Log the node state to SQLite
-def log_state(node_id, status, timestamp, signature, aggregated_public_key, non_signers):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Serialize the signers list as a JSON string
-    non_signers_json = json.dumps(non_signers)
-    
+    conn = get_db()
+    with db_lock:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                node_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                signature TEXT NOT NULL,
+                non_signers TEXT NOT NULL
+            )
+        ''')
+        # A proof replayed after a crash maps to the same row
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS logs_node_timestamp ON logs (node_id, timestamp)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS variables (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        # Rollups maintained by the sequencer reader so reports never scan logs
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS outages (
+                node_id TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                PRIMARY KEY (node_id, start)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS down_counts (
+                node_id TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (node_id, bucket)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS down_counts_bucket ON down_counts (bucket)')
+
+
+# Fold one down proof into the outage intervals and the per-bucket down counts
+def _update_rollups(cursor, node_id, timestamp):
     cursor.execute('''
-        INSERT INTO logs (node_id, status, timestamp, signature, aggregated_public_key, non_signers)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (node_id, status, timestamp, signature, aggregated_public_key, non_signers_json))
-    
-    conn.commit()
-    conn.close()
+        INSERT INTO down_counts (node_id, bucket, count) VALUES (?, ?, 1)
+        ON CONFLICT(node_id, bucket) DO UPDATE SET count=count + 1
+    ''', (node_id, timestamp - timestamp % ROLLUP_BUCKET))
+
+    # Merge [timestamp, timestamp + span] with every outage it touches
+    start, end = timestamp, timestamp + DOWN_EVENT_SPAN
+    cursor.execute('SELECT start, end FROM outages WHERE node_id=? AND start<=? AND end>=?', (node_id, end, start))
+    overlapping = cursor.fetchall()
+    for outage_start, outage_end in overlapping:
+        start, end = min(start, outage_start), max(end, outage_end)
+    cursor.executemany('DELETE FROM outages WHERE node_id=? AND start=?', [(node_id, outage_start) for outage_start, _ in overlapping])
+    cursor.execute('INSERT INTO outages (node_id, start, end) VALUES (?, ?, ?)', (node_id, start, end))
+
+
+# Index of the last sequencer batch whose proofs are logged
+def get_last_index():
+    conn = get_db()
+    with db_lock:
+        row = conn.execute('SELECT value FROM variables WHERE key=?', ('last_process_indexes',)).fetchone()
+    return int(row[0]) if row else 0
+
+
+# Log the verified proofs of a batch and advance the cursor in one transaction
+def log_states(proofs, index):
+    conn = get_db()
+    with db_lock:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for proof in proofs:
+                # Serialize the non-signers list as a JSON string
+                cursor.execute('''
+                    INSERT OR IGNORE INTO logs (node_id, status, timestamp, signature, non_signers)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (proof['node_id'], proof['status'], proof['timestamp'], proof['aggregated_signature'],
+                      json.dumps(proof['non_signers'])))
+                # Replayed proofs are ignored above and must not be counted twice
+                if cursor.rowcount == 1 and proof['status'] == 'down':
+                    _update_rollups(cursor, proof['node_id'], int(proof['timestamp']))
+            cursor.execute('''
+                INSERT INTO variables (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value=excluded.value
+            ''', ('last_process_indexes', str(index)))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+
 
 def aggregated_public_keys():
     public_key_list = []
@@ -107,30 +196,107 @@ def aggregated_public_keys():
     return aggregated_key
 
 
-        
-# Verify a proof from the sequencer
-def verify_message(message, signature, non_signers, aggregated_key):
-    try:
-        # Get the public keys of the non-signers
-        non_signers_public_key_list = [OPERATORS[operator_id]["public_key"] for operator_id in non_signers]
-        
-        # Adjust the aggregated key by removing non-signers' keys
-        for public_key_hex in non_signers_public_key_list:
-            non_signer_key = G1Element.from_bytes(bytes.fromhex(public_key_hex))  # Adjust to G1Element
-            aggregated_key -= non_signer_key
-        
-        # Verify the signature
-        message_bytes = message.encode('utf-8')
-        
-        # `signature` should be a G2Element, so ensure it's deserialized if passed as a string
-        if isinstance(signature, str):
-            signature = G2Element.from_bytes(base64.b64decode(signature))
-        
-        # Perform verification
-        return AugSchemeMPL.verify(aggregated_key, message_bytes, signature)
-    except Exception as e:
-        print(f"Verification failed: {e}")
-        return False
+# Deserialized operator public keys, G1 points are parsed once per operator
+operator_key_cache = {}
+
+
+def get_operator_key(operator_id):
+    key = operator_key_cache.get(operator_id)
+    if key is None:
+        key = G1Element.from_bytes(bytes.fromhex(OPERATORS[operator_id]["public_key"]))
+        operator_key_cache[operator_id] = key
+    return key
+
+
+# Aggregate public keys of the signers, memoized per non-signer bitmap.
+# The table is rebuilt whenever the OPERATORS registry changes.
+aggregate_key_table = OrderedDict()
+aggregate_key_lock = Lock()
+aggregate_key_registry = None  # Registry the table was built for
+operator_bits = {}  # operator_id -> bit in the non-signer bitmap
+all_operators_key = None
+
+
+# Drop every derived key if operators were added, removed or rotated their keys
+def _refresh_aggregate_key_table():
+    global aggregate_key_registry, operator_bits, all_operators_key
+    registry = tuple(sorted((operator_id, details["public_key"]) for operator_id, details in OPERATORS.items()))
+    if registry != aggregate_key_registry:
+        aggregate_key_table.clear()
+        operator_key_cache.clear()
+        operator_bits = {operator_id: bit for bit, (operator_id, _) in enumerate(registry)}
+        all_operators_key = aggregated_public_keys()
+        aggregate_key_registry = registry
+
+
+# Aggregate key of the operators that signed, i.e. all operators minus the non-signers
+def signers_public_key(non_signers):
+    with aggregate_key_lock:
+        _refresh_aggregate_key_table()
+        bitmap = 0
+        for operator_id in non_signers:
+            bitmap |= 1 << operator_bits[operator_id]
+
+        key = aggregate_key_table.get(bitmap)
+        if key is not None:
+            aggregate_key_table.move_to_end(bitmap)
+            return key
+
+        key = all_operators_key
+        for operator_id in operator_bits:
+            if bitmap & (1 << operator_bits[operator_id]):
+                key = key + get_operator_key(operator_id).negate()
+        aggregate_key_table[bitmap] = key
+        if len(aggregate_key_table) > AGGREGATE_KEY_CACHE_SIZE:
+            aggregate_key_table.popitem(last=False)
+        return key
+
+
+# Message an operator signs for a node status
+def proof_message(proof):
+    return f"{proof['node_id']},{proof['status']},{proof['timestamp']}"
+
+
+# Verify every proof of a batch, returning one bool per proof
+def verify_proofs(proofs):
+    prepared = []
+    for proof in proofs:
+        try:
+            prepared.append((
+                signers_public_key(proof['non_signers']),
+                proof_message(proof).encode('utf-8'),
+                G2Element.from_bytes(base64.b64decode(proof['aggregated_signature'])),
+            ))
+        except Exception as e:
+            print(f"Malformed proof {proof}: {e}")
+            prepared.append(None)
+
+    results = [False] * len(proofs)
+    _verify_group(prepared, [i for i, item in enumerate(prepared) if item is not None], results)
+    return results
+
+
+# One multi-pairing check for the whole group, bisecting only when it fails to isolate bad proofs
+def _verify_group(prepared, indexes, results):
+    if not indexes:
+        return
+    if len(indexes) == 1:
+        public_key, message_bytes, signature = prepared[indexes[0]]
+        results[indexes[0]] = AugSchemeMPL.verify(public_key, message_bytes, signature)
+        return
+
+    public_keys = [prepared[i][0] for i in indexes]
+    messages = [prepared[i][1] for i in indexes]
+    signature = AugSchemeMPL.aggregate([prepared[i][2] for i in indexes])
+    if AugSchemeMPL.aggregate_verify(public_keys, messages, signature):
+        for i in indexes:
+            results[i] = True
+        return
+
+    middle = len(indexes) // 2
+    _verify_group(prepared, indexes[:middle], results)
+    _verify_group(prepared, indexes[middle:], results)
+
 
 # Sign a message using the operator's private key
 def sign_message(message):
@@ -146,45 +312,289 @@ def status():
         "timestamp": int(time.time()),
     })
 
+# Signed probe results per target node, and the probe currently running for each target
+check_cache = {}  # node id -> (expires_at, signed status)
+check_in_flight = {}  # node id -> Future of the running probe
+check_lock = Lock()
+
+
+# Resolve the node a /check_node request asks about to (node_id, registry socket). Only the
+# registry socket is ever probed, so a caller can't get a node attested as down by pointing
+# node_url at an unreachable host. A bare node_url is accepted for a node in the registry.
+def check_target(data):
+    node_id = data.get('node_id') or URLMAP.get(data.get('node_url'))
+    target_node_url = OPERATORS.get(node_id, {}).get('socket')
+    if not target_node_url:
+        return None, None
+    return node_id, target_node_url
+
+
+# Probe a node and sign what we saw; an unreachable node is attested as down
+def probe_and_sign(target_node_url, node_id):
+    try:
+        response = requests.get(f"{target_node_url}/status", timeout=CHECK_TIMEOUT)
+        target_status = response.json()
+    except Exception as e:
+        print(f"Probe of {target_node_url} failed: {e}")
+        target_status = {"node_id": node_id, "status": "down", "timestamp": int(time.time())}
+    status_message = f"{target_status['node_id']},{target_status['status']},{target_status['timestamp']}"
+    signature = sign_message(status_message)
+    return {
+        "node_id": target_status['node_id'],
+        "status": target_status['status'],
+        "timestamp": target_status['timestamp'],
+        "signature": base64.b64encode(bytes(signature)).decode('utf-8'),
+    }
+
+
+# Return a fresh signed status, sharing one probe between concurrent checks of the same target
+def checked_status(target_node_url, node_id):
+    with check_lock:
+        cached = check_cache.get(node_id)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        future = check_in_flight.get(node_id)
+        owner = future is None
+        if owner:
+            future = Future()
+            check_in_flight[node_id] = future
+
+    if owner:
+        try:
+            result = probe_and_sign(target_node_url, node_id)
+            with check_lock:
+                check_cache[node_id] = (time.time() + CHECK_CACHE_TTL, result)
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with check_lock:
+                check_in_flight.pop(node_id, None)
+    return future.result()
+
+
 # Endpoint to check the status of another node
 @app.route('/check_node', methods=['POST'])
 def check_node():
-    data = request.json
-    target_node_url = data['node_url']
+    node_id, target_node_url = check_target(request.json or {})
+    if not target_node_url:
+        return jsonify({"error": "Unknown node"}), 400
     try:
-        response = requests.get(f"{target_node_url}/status")
-        target_status = response.json()
-        status_message = f"{target_status['node_id']},{target_status['status']},{target_status['timestamp']}"
-        signature = sign_message(status_message)
-        return jsonify({
-            "node_id": target_status['node_id'],
-            "status": target_status['status'],
-            "timestamp": target_status['timestamp'],
-            "signature": base64.b64encode(bytes(signature)).decode('utf-8'),
-        })
+        return jsonify(checked_status(target_node_url, node_id))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Per-thread read-only connections for the query endpoints
+read_connections = local()
+
+
+def get_read_db():
+    conn = getattr(read_connections, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(f'file:{DATABASE}?mode=ro', uri=True)
+        read_connections.conn = conn
+    return conn
+
+
+# Parse the [start, end) time range of a query, defaulting to everything up to now
+def query_range():
+    start = request.args.get('start', 0, type=int)
+    end = request.args.get('end', int(time.time()), type=int)
+    return start, max(start, end)
+
+
+# Uptime percentage of a node over a time range
+@app.route('/uptime', methods=['GET'])
+def uptime():
+    node_id = request.args.get('node_id')
+    if not node_id:
+        return jsonify({"error": "node_id is required"}), 400
+    start, end = query_range()
+    row = get_read_db().execute('''
+        SELECT COALESCE(SUM(MIN(end, ?) - MAX(start, ?)), 0) FROM outages
+        WHERE node_id=? AND start<? AND end>?
+    ''', (end, start, node_id, end, start)).fetchone()
+    downtime = row[0]
+    span = end - start
+    return jsonify({
+        "node_id": node_id,
+        "start": start,
+        "end": end,
+        "downtime_seconds": downtime,
+        "uptime_percentage": 100.0 * (span - downtime) / span if span else 100.0,
+    })
+
+
+# Outage intervals overlapping a time range, for one node or all of them
+@app.route('/outages', methods=['GET'])
+def outages():
+    node_id = request.args.get('node_id')
+    start, end = query_range()
+    query = 'SELECT node_id, start, end FROM outages WHERE start<? AND end>?'
+    params = [end, start]
+    if node_id:
+        query += ' AND node_id=?'
+        params.append(node_id)
+    rows = get_read_db().execute(query + ' ORDER BY start', params).fetchall()
+    return jsonify([{"node_id": row[0], "start": row[1], "end": row[2]} for row in rows])
+
+
+# Down proofs per time bucket over a range, for one node or all of them
+@app.route('/down_counts', methods=['GET'])
+def down_counts():
+    node_id = request.args.get('node_id')
+    start, end = query_range()
+    bucket = request.args.get('bucket', ROLLUP_BUCKET, type=int)
+    if bucket <= 0 or bucket % ROLLUP_BUCKET:
+        return jsonify({"error": f"bucket must be a positive multiple of {ROLLUP_BUCKET}"}), 400
+    query = 'SELECT node_id, (bucket / ?) * ? AS period, SUM(count) FROM down_counts WHERE bucket>=? AND bucket<?'
+    params = [bucket, bucket, start - start % ROLLUP_BUCKET, end]
+    if node_id:
+        query += ' AND node_id=?'
+        params.append(node_id)
+    rows = get_read_db().execute(query + ' GROUP BY node_id, period ORDER BY period', params).fetchall()
+    return jsonify([{"node_id": row[0], "bucket_start": row[1], "down_count": row[2]} for row in rows])
+
+
+# Decode a sequencer batch into its well-formed proofs, so logging them can't fail on their content
+def decode_proofs(batch):
+    proofs = []
+    for proof in load_batch(batch):
+        if (isinstance(proof, dict)
+                and all(isinstance(proof.get(key), str) for key in ('node_id', 'status', 'aggregated_signature'))
+                and type(proof.get('timestamp')) is int and isinstance(proof.get('non_signers'), list)):
+            proofs.append(proof)
+        else:
+            print(f"Malformed proof {proof}")
+    return proofs
+
+
+# Keep only the proofs of a batch that verify
+def verified_proofs(proofs):
+    # Check the whole batch at once, falling back to bisection only if something is invalid
+    return [proof for proof, valid in zip(proofs, verify_proofs(proofs)) if valid]
+
+
+# Log the verified proofs of a batch together with its index
+def apply_proofs(verified, index):
+    log_states(verified, index)
+    for proof in verified:
+        print(f"Proof verified and logged: {proof}")
+
+
 # Read and validate proofs from the sequencer
 def read_from_sequencer():
-    aggregated_key = aggregated_public_keys()
-    
-    while True:
-        for batch, index in zellular.batches(after=0):
-            proofs = json.loads(batch)
-            for proof in proofs:
-                message = f"{proof['node_id']},{proof['status']},{proof['timestamp']}"
-                if verify_message(message, proof['signature'],proof['non_signers'],aggregated_key):
-                    log_state(proof['node_id'], 
-                              proof['status'], 
-                              proof['timestamp'], 
-                              proof['signature'],
-                              proof['aggregated_signature'],
-                              proof['non_signers'])
-                    print(f"Proof verified and logged: {proof}")
-        time.sleep(5)
+    BatchConsumer(
+        fetch=lambda after: zellular.batches(after=after),
+        decode=decode_proofs,
+        verify=verified_proofs,
+        apply=apply_proofs,
+        # Resume after the last batch committed, restarts only see new batches
+        after=get_last_index(),
+    ).run()
+
+
+#-------------------------------------
+# Asyncio serving mode: async peer probes and signing off the loop
+async_client = None  # httpx.AsyncClient, created when the ASGI app starts
+async_checks = {}  # node id -> Task of the running probe
+
+
+async def async_probe_and_sign(target_node_url, node_id):
+    try:
+        response = await async_client.get(f"{target_node_url}/status")
+        target_status = response.json()
+    except Exception as e:
+        print(f"Probe of {target_node_url} failed: {e}")
+        target_status = {"node_id": node_id, "status": "down", "timestamp": int(time.time())}
+    status_message = f"{target_status['node_id']},{target_status['status']},{target_status['timestamp']}"
+    # BLS signing is CPU bound, keep it off the event loop
+    signature = await asyncio.get_running_loop().run_in_executor(None, sign_message, status_message)
+    return {
+        "node_id": target_status['node_id'],
+        "status": target_status['status'],
+        "timestamp": target_status['timestamp'],
+        "signature": base64.b64encode(bytes(signature)).decode('utf-8'),
+    }
+
+
+# Async counterpart of checked_status, sharing its signed-result cache
+async def async_checked_status(target_node_url, node_id):
+    with check_lock:
+        cached = check_cache.get(node_id)
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+    task = async_checks.get(node_id)
+    if task is None:
+        task = asyncio.create_task(async_probe_and_sign(target_node_url, node_id))
+        async_checks[node_id] = task
+
+        def finish(task):
+            async_checks.pop(node_id, None)
+            if not task.cancelled() and task.exception() is None:
+                with check_lock:
+                    check_cache[node_id] = (time.time() + CHECK_CACHE_TTL, task.result())
+
+        task.add_done_callback(finish)
+    # A caller going away must not cancel the probe others are waiting on
+    return await asyncio.shield(task)
+
+
+# Build the ASGI app. It is only built with --asgi, so fastapi, uvicorn and httpx are not needed otherwise.
+def create_asgi_app():
+    import httpx
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+    try:
+        from a2wsgi import WSGIMiddleware
+    except ImportError:
+        # Deprecated by starlette in favour of a2wsgi, still used when a2wsgi is not installed
+        from starlette.middleware.wsgi import WSGIMiddleware
+
+    asgi_app = FastAPI()
+
+    @asgi_app.on_event("startup")
+    async def start_async_runtime():
+        global async_client
+        async_client = httpx.AsyncClient(timeout=CHECK_TIMEOUT)
+        # The pipelined consumer polls again as soon as batches arrive and backs off when idle
+        Thread(target=read_from_sequencer, daemon=True).start()
+
+    @asgi_app.on_event("shutdown")
+    async def stop_async_runtime():
+        await async_client.aclose()
+
+    @asgi_app.get('/status')
+    async def async_status():
+        return {
+            "node_id": NODE_ID,
+            "status": "up",
+            "timestamp": int(time.time()),
+        }
+
+    @asgi_app.post('/check_node')
+    async def async_check_node(request: Request):
+        node_id, target_node_url = check_target(await request.json())
+        if not target_node_url:
+            return JSONResponse({"error": "Unknown node"}, status_code=400)
+        try:
+            return await async_checked_status(target_node_url, node_id)
+        except Exception as e:
+            return JSONResponse({"error": str(e)}, status_code=500)
+
+    # Everything else (the history API) is still served by the Flask app
+    asgi_app.mount('/', WSGIMiddleware(app))
+
+    return asgi_app
+
 
 if __name__ == '__main__':
     init_db()
-    Thread(target=read_from_sequencer, daemon=True).start()
-    app.run(host='0.0.0.0', port=PORT)
+    # Run the asyncio runtime with --asgi, Flask with a polling reader thread otherwise
+    if '--asgi' in sys.argv:
+        import uvicorn
+        uvicorn.run(create_asgi_app(), host='0.0.0.0', port=PORT)
+    else:
+        Thread(target=read_from_sequencer, daemon=True).start()
+        app.run(host='0.0.0.0', port=PORT)
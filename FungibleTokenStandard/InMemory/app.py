@@ -1,15 +1,29 @@
-from flask import Flask, request, jsonify
-from ecdsa import VerifyingKey, SECP256k1, BadSignatureError
+from flask import Flask, request, jsonify, abort, Response
 from zellular import Zellular , get_operators
-from threading import Thread
-from uuid import uuid4
-import base64
+from threading import Thread, Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import requests
+import asyncio
 import time
-import json
 import random
 import hashlib
 import os
+import sys
+import mmap
+import heapq
+import struct
+import zlib
+import multiprocessing
+from array import array
+
+# The pipelined batch consumer, the sequencer client, the submission pipeline and the transfer
+# verification are shared by the apps and live at the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from batch_consumer import BatchConsumer, InvalidBatch
+from sequencer_client import SequencerClient
+from token_transfers import verify, verify_batch, verify_pool, key_cache, build_transfer_tx, decode_batch
+from submission_pipeline import SubmissionPipeline, AsyncSubmissionPipeline
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
@@ -32,91 +46,487 @@ TOKEN_NAME = "ZellularToken"
 TOKEN_SYMBOL = "ZTK"
 TOKEN_DECIMALS = 18
 TOTAL_SUPPLY = 1000000000 * (10 ** TOKEN_DECIMALS)  # 1 billion tokens
-BALANCES_FILE = 'balances_dump.json'
-VARIABLES_FILE = 'variables_dump.json'
+SNAPSHOT_FILE = 'balances.snapshot'  # Full sorted binary snapshot of balances
+DELTA_FILE = 'balances.delta'  # Dirty-key deltas appended between full snapshots
+CHECKPOINT_INTERVAL = 5  # Seconds between delta checkpoints
+FULL_SNAPSHOT_EVERY = 100  # Deltas appended before they are compacted into a full snapshot
+SYNC_FILE = 'balances.sync'  # Snapshot served to syncing peers
+SYNC_SNAPSHOT_EVERY = 1000  # Batch indexes between sync snapshots, the same on every replica
+SYNC_CHUNK_SIZE = 1024 * 1024  # Bytes per content-addressed snapshot chunk
+SYNC_QUORUM = 2  # Peers that must advertise the same snapshot before we trust it
+SYNC_TIMEOUT = 10  # Seconds allowed for a single manifest/chunk request
+STATE_SHARDS = int(os.environ.get('STATE_SHARDS', 1))  # Processes owning account partitions, 1 applies in-process
+SUBMIT_IN_FLIGHT = 4  # Batches that may be awaiting a sequencer response at once
+SUBMIT_TIMEOUT = 10  # Seconds one operator may take to accept a batch
+APPLIED_TX_BATCHES = 1000  # Batches whose tx_ids are remembered to drop batches the sequencer got twice
 #-------------------------------------
 
 zellular = Zellular(APP_NAME, BASE_URLS[0])
 
-# Initialize balances and variables as dictionaries
+# Balances changed since the current snapshot (the snapshot itself is read lazily) and variables
 balances = {}
 variables = {}
+snapshot = None  # SnapshotView of SNAPSHOT_FILE, or None before the first full snapshot
+dirty_keys = set()  # Accounts changed since the last checkpoint
+applied_batches = OrderedDict()  # Batch index -> tx_ids applied from it, for the last APPLIED_TX_BATCHES batches
+applied_tx_ids = {}  # tx_id -> batch index it was applied from, for every id in applied_batches
+window_changes = []  # (index, tx_ids) applied since the last checkpoint
+state_lock = Lock()  # Held while a batch is applied or a checkpoint copies state
 
-
-# Function to check if files exist and load them
+#-------------------------------------
+# Snapshot layout: header | window records | entries sorted by key | one offset per entry
+#   header: magic, format version, Zellular index it reflects, entry count, window length in bytes
+#   window: batch index, tx_id count, then key length + utf-8 tx_id per applied tx
+#   entry:  key length, utf-8 key, 128-bit big-endian balance
+# Delta record: header | entries | window records | crc32 of the body
+SNAPSHOT_MAGIC = b'ZSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('>4sHQQQ')
+WINDOW_RECORD = struct.Struct('>QI')
+DELTA_MAGIC = b'ZDLT'
+DELTA_HEADER = struct.Struct('>4sQII')
+KEY_LENGTH = struct.Struct('>H')
+OFFSET = struct.Struct('>Q')
+CRC = struct.Struct('>I')
+BALANCE_SIZE = 16
+
+
+# Encode one (key, balance) entry
+def _encode_entry(key, balance):
+    key_bytes = key.encode('utf-8')
+    return KEY_LENGTH.pack(len(key_bytes)) + key_bytes + balance.to_bytes(BALANCE_SIZE, 'big')
+
+
+# Decode the entry starting at offset, returning (key, balance, next_offset)
+def _decode_entry(buf, offset):
+    (key_length,) = KEY_LENGTH.unpack_from(buf, offset)
+    offset += KEY_LENGTH.size
+    key = bytes(buf[offset:offset + key_length]).decode('utf-8')
+    offset += key_length
+    balance = int.from_bytes(buf[offset:offset + BALANCE_SIZE], 'big')
+    return key, balance, offset + BALANCE_SIZE
+
+
+# Encode the tx_ids applied from one batch as a window record
+def _encode_window_record(index, tx_ids):
+    parts = [WINDOW_RECORD.pack(index, len(tx_ids))]
+    for tx_id in tx_ids:
+        tx_id_bytes = tx_id.encode('utf-8')
+        parts.append(KEY_LENGTH.pack(len(tx_id_bytes)) + tx_id_bytes)
+    return b''.join(parts)
+
+
+# Yield (index, tx_ids) for the window records between offset and end
+def _decode_window(buf, offset, end):
+    while offset < end:
+        index, count = WINDOW_RECORD.unpack_from(buf, offset)
+        offset += WINDOW_RECORD.size
+        tx_ids = []
+        for _ in range(count):
+            (tx_id_length,) = KEY_LENGTH.unpack_from(buf, offset)
+            offset += KEY_LENGTH.size
+            tx_ids.append(bytes(buf[offset:offset + tx_id_length]).decode('utf-8'))
+            offset += tx_id_length
+        yield index, tx_ids
+
+
+# fsync the directory holding path so a rename survives a crash
+def _fsync_dir(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Atomically write a full snapshot from items already sorted by utf-8 key, tagged with its Zellular index
+# and carrying the dedupe window as (index, tx_ids) in batch order
+def write_snapshot(sorted_items, index, window=(), path=SNAPSHOT_FILE):
+    tmp_path = path + '.tmp'
+    offsets = array('Q')
+    window_bytes = b''.join(_encode_window_record(batch_index, tx_ids) for batch_index, tx_ids in window)
+    with open(tmp_path, 'wb') as f:
+        # Count is patched below
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, index, 0, len(window_bytes)))
+        f.write(window_bytes)
+        position = SNAPSHOT_HEADER.size + len(window_bytes)
+        for key, balance in sorted_items:
+            entry = _encode_entry(key, balance)
+            offsets.append(position)
+            f.write(entry)
+            position += len(entry)
+        count = len(offsets)
+        if sys.byteorder == 'little':
+            offsets.byteswap()  # Offsets are stored big-endian like every other field
+        f.write(offsets.tobytes())
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, index, count, len(window_bytes)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+# Read-only, memory-mapped snapshot with binary-search lookup over its offset table
+class SnapshotView:
+    def __init__(self, path=SNAPSHOT_FILE):
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.index, self.count, window_length = SNAPSHOT_HEADER.unpack_from(self.buf, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot file {path}")
+        self.window_start = SNAPSHOT_HEADER.size
+        self.window_end = self.window_start + window_length
+        self.offsets_start = len(self.buf) - self.count * OFFSET.size
+
+    # Return (key bytes, offset of the balance) of the entry at a sorted position
+    def _entry_at(self, position):
+        (offset,) = OFFSET.unpack_from(self.buf, self.offsets_start + position * OFFSET.size)
+        (key_length,) = KEY_LENGTH.unpack_from(self.buf, offset)
+        key_start = offset + KEY_LENGTH.size
+        return self.buf[key_start:key_start + key_length], key_start + key_length
+
+    def get(self, key, default=None):
+        target = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry_at(middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count:
+            entry_key, balance_offset = self._entry_at(low)
+            if entry_key == target:
+                return int.from_bytes(self.buf[balance_offset:balance_offset + BALANCE_SIZE], 'big')
+        return default
+
+    # Sequential scan in key order
+    def items(self):
+        offset = self.window_end
+        for _ in range(self.count):
+            key, balance, offset = _decode_entry(self.buf, offset)
+            yield key, balance
+
+    # (index, tx_ids) of the dedupe window at the snapshot's index, in batch order
+    def window(self):
+        return _decode_window(self.buf, self.window_start, self.window_end)
+
+
+# Merge sorted snapshot entries with sorted newer values, the newer value winning on equal keys
+def _merge_sorted(snapshot_items, newer_items):
+    merged = heapq.merge(
+        ((key.encode('utf-8'), 0, key, balance) for key, balance in newer_items),
+        ((key.encode('utf-8'), 1, key, balance) for key, balance in snapshot_items),
+    )
+    previous = None
+    for key_bytes, _, key, balance in merged:
+        if key_bytes != previous:
+            previous = key_bytes
+            yield key, balance
+
+
+# Append the changed balances and newly applied tx_ids of a checkpoint to the delta log
+def append_delta(changes, index, window=(), path=DELTA_FILE):
+    body = b''.join(_encode_entry(key, balance) for key, balance in changes.items())
+    body += b''.join(_encode_window_record(batch_index, tx_ids) for batch_index, tx_ids in window)
+    with open(path, 'ab') as f:
+        f.write(DELTA_HEADER.pack(DELTA_MAGIC, index, len(changes), len(body)) + body + CRC.pack(zlib.crc32(body)))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Yield (index, changes, window) for every intact delta record newer than after_index
+def read_deltas(after_index, path=DELTA_FILE):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        buf = memoryview(f.read())
+    offset = 0
+    while offset + DELTA_HEADER.size <= len(buf):
+        magic, index, count, body_length = DELTA_HEADER.unpack_from(buf, offset)
+        body_start = offset + DELTA_HEADER.size
+        body_end = body_start + body_length
+        if magic != DELTA_MAGIC or body_end + CRC.size > len(buf):
+            print("Ignoring truncated delta record.")
+            return
+        body = buf[body_start:body_end]
+        if CRC.unpack_from(buf, body_end)[0] != zlib.crc32(body):
+            print("Ignoring corrupt delta record.")
+            return
+        if index > after_index:
+            changes = {}
+            entry_offset = 0
+            for _ in range(count):
+                key, balance, entry_offset = _decode_entry(body, entry_offset)
+                changes[key] = balance
+            yield index, changes, list(_decode_window(body, entry_offset, len(body)))
+        offset = body_end + CRC.size
+
+
+# Function to check if files exist and load them (once, at startup)
 def load_files():
-    # Load balances file if it exists
-    if os.path.exists(BALANCES_FILE):
-        with open(BALANCES_FILE, 'r') as f:
-            global balances
-            balances = json.load(f)
-            print("Balances loaded from file.")
-    else:
-        # Initialize genesis address with total supply if file doesn't exist
-        balances[GENESIS_ADDRESS] = TOTAL_SUPPLY
-        print("Balances file not found, created with genesis address.")
-
-    # Load variables file if it exists
-    if os.path.exists(VARIABLES_FILE):
-        with open(VARIABLES_FILE, 'r') as f:
-            global variables
-            variables = json.load(f)
-            print("Variables loaded from file.")
+    global balances, snapshot
+    if os.path.exists(SNAPSHOT_FILE):
+        # Only the header is parsed here, accounts are looked up lazily from the mapping
+        view = SnapshotView(SNAPSHOT_FILE)
+        index = view.index
+        changes = {}
+        window = list(view.window())
+        for index, delta, delta_window in read_deltas(view.index):
+            changes.update(delta)
+            window.extend(delta_window)
+        with state_lock:
+            snapshot = view
+            balances = changes
+            variables["last_process_indexes"] = index
+            dirty_keys.clear()
+            _reset_window(window, index)
+        print(f"Snapshot mapped with {view.count} accounts, state at index {index}.")
     else:
-        # Initialize default variables
-        variables["last_process_indexes"] = 0
-        print("Variables file not found, initialized with default values.")
-
-# Function to initialize the system
-@app.before_request
-def initialize():
-    load_files()
-
-
-# Function to verify signatures
-def verify(tx):
-    message = ','.join([tx[key] for key in ['recipient', 'amount']]).encode('utf-8')
+        # Initialize genesis address with total supply if no snapshot exists
+        with state_lock:
+            snapshot = None
+            balances = {GENESIS_ADDRESS: TOTAL_SUPPLY}
+            variables["last_process_indexes"] = 0
+            dirty_keys.add(GENESIS_ADDRESS)
+            _reset_window([], 0)
+        print("Snapshot not found, created with genesis address.")
+
+
+# Current balance of an account: recent changes first, then the mapped snapshot
+def get_balance(public_key):
+    # A missing key (no public_key query argument) holds nothing, like an unknown account
+    if public_key is None:
+        return 0
+    balance = balances.get(public_key)
+    if balance is not None:
+        return balance
+    view = snapshot
+    if view is not None:
+        return view.get(public_key, 0)
+    return 0
+
+
+# Sync snapshots: full snapshots of the state right after every SYNC_SNAPSHOT_EVERY-th batch.
+# Every replica takes them at the same indexes from the same state, so peers serve byte-identical
+# files and a syncing node finds a quorum agreeing on one manifest root. The periodic checkpoints
+# run on wall-clock timers, their snapshots almost never match across replicas.
+sync_snapshot_lock = Lock()  # Held while a sync snapshot is written
+sync_snapshot_index = 0  # Index of the newest sync snapshot written
+
+
+# Copy the state at batch `index` and write it to SYNC_FILE in the background, caller holds state_lock
+def take_sync_snapshot(index):
+    Thread(target=_write_sync_snapshot, args=(snapshot, dict(balances), list(applied_batches.items()), index),
+           daemon=True).start()
+
+
+def _write_sync_snapshot(view, changes, window, index):
+    global sync_snapshot_index
+    with sync_snapshot_lock:
+        # A slow write must not replace a newer sync snapshot
+        if index <= sync_snapshot_index:
+            return
+        newer_items = sorted(changes.items(), key=lambda item: item[0].encode('utf-8'))
+        write_snapshot(_merge_sorted(view.items() if view else [], newer_items), index, window, path=SYNC_FILE)
+        sync_snapshot_index = index
+    print(f"Sync snapshot written at index {index}.")
+
+
+# Build the chunk manifest of the sync snapshot (cached until the file changes)
+snapshot_manifest = {}
+
+
+def get_snapshot_manifest():
+    global snapshot_manifest
+    stat = os.stat(SYNC_FILE)
+    if snapshot_manifest.get("_stat") != (stat.st_mtime_ns, stat.st_size):
+        chunks = []
+        with open(SYNC_FILE, 'rb') as f:
+            _, _, index, _, _ = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            f.seek(0)
+            for buf in iter(lambda: f.read(SYNC_CHUNK_SIZE), b''):
+                chunks.append(hashlib.sha256(buf).hexdigest())
+        snapshot_manifest = {
+            "_stat": (stat.st_mtime_ns, stat.st_size),
+            "index": index,
+            "size": stat.st_size,
+            "chunk_size": SYNC_CHUNK_SIZE,
+            "chunks": chunks,
+            # The root commits to every chunk, peers agreeing on it serve identical bytes
+            "root": hashlib.sha256(''.join(chunks).encode('utf-8')).hexdigest(),
+        }
+    return {key: value for key, value in snapshot_manifest.items() if not key.startswith('_')}
+
+
+# Fetch the snapshot manifest advertised by a peer
+def fetch_manifest(base_url):
     try:
-        public_key = base64.b64decode(tx['public_key'])
-        signature = base64.b64decode(tx['signature'])
-        vk = VerifyingKey.from_string(public_key, curve=SECP256k1)
-        vk.verify(signature, message)
-    except (BadSignatureError, ValueError):
-        return False
-    return True
-
-
-# Function to calculate the hash of a file
-def calculate_file_hash(filepath):
-    hasher = hashlib.sha256()
-    with open(filepath, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
-    return hasher.hexdigest()
-
-
-# Function to fetch the latest balances file from a random URL
-def fetch_latest_balances():
-    selected_base_url = random.choice(BASE_URLS)
-    try:
-        response = requests.get(f"{selected_base_url}/balances_dump.json")
+        response = requests.get(f"{base_url}/snapshot/manifest", timeout=SYNC_TIMEOUT)
         if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"Failed to fetch balances from {selected_base_url}")
-            return None
+            return base_url, response.json()
+        print(f"Failed to fetch manifest from {base_url}")
     except Exception as e:
-        print(f"Error fetching balances: {e}")
+        print(f"Error fetching manifest from {base_url}: {e}")
+    return base_url, None
+
+
+# Download one chunk, trying each peer in turn until its hash matches the manifest
+def fetch_chunk(fd, manifest, number, peers):
+    for attempt in range(len(peers)):
+        base_url = peers[(number + attempt) % len(peers)]
+        try:
+            response = requests.get(f"{base_url}/snapshot/chunk/{number}", timeout=SYNC_TIMEOUT)
+            if response.status_code == 200 and hashlib.sha256(response.content).hexdigest() == manifest["chunks"][number]:
+                os.pwrite(fd, response.content, number * manifest["chunk_size"])
+                return True
+            print(f"Rejected chunk {number} from {base_url}")
+        except Exception as e:
+            print(f"Error fetching chunk {number} from {base_url}: {e}")
+    return False
+
+
+# Function to fetch the latest snapshot agreed on by a quorum of peers, streaming it to disk chunk by chunk
+def fetch_latest_balances():
+    with ThreadPoolExecutor(max_workers=len(BASE_URLS)) as executor:
+        manifests = [result for result in executor.map(fetch_manifest, BASE_URLS) if result[1]]
+
+    # Group peers by the snapshot they advertise and pick the newest one enough of them agree on
+    candidates = {}
+    for base_url, manifest in manifests:
+        candidates.setdefault(manifest["root"], (manifest, []))[1].append(base_url)
+    quorum = min(SYNC_QUORUM, len(BASE_URLS))
+    agreed = [candidate for candidate in candidates.values() if len(candidate[1]) >= quorum]
+    if not agreed:
+        print("No snapshot is advertised by a quorum of peers")
         return None
+    manifest, peers = max(agreed, key=lambda candidate: candidate[0]["index"])
 
-
-# Function to replay transactions to update balances
-def replay_transactions(latest_transactions):
-    for tx in latest_transactions:
-        if tx["operation"] == "transfer":
-            _transfer(tx)
+    # Chunks are written in place as they arrive, the full state is never held in memory
+    tmp_path = SNAPSHOT_FILE + '.sync'
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, manifest["size"])
+        with ThreadPoolExecutor(max_workers=len(peers) * 2) as executor:
+            results = list(executor.map(lambda number: fetch_chunk(fd, manifest, number, peers),
+                                        range(len(manifest["chunks"]))))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if not all(results):
+        os.remove(tmp_path)
+        print("Snapshot sync failed, some chunks could not be verified")
+        return None
+    return tmp_path, manifest["index"]
+
+
+# Catch up a lagging node: install a verified peer snapshot, then replay only the batches after it
+def catch_up():
+    fetched = fetch_latest_balances()
+    if fetched is not None:
+        tmp_path, index = fetched
+        if index > variables.get("last_process_indexes", 0):
+            os.replace(tmp_path, SNAPSHOT_FILE)
+            _fsync_dir(SNAPSHOT_FILE)
+            # Local deltas belong to the replaced snapshot
+            if os.path.exists(DELTA_FILE):
+                os.remove(DELTA_FILE)
+            load_files()
+            print(f"Installed peer snapshot at index {index}.")
         else:
-            print("Invalid transaction", tx)
+            os.remove(tmp_path)
+            print("Local state is already as new as the peer snapshot.")
+
+    for batch, index in zellular.batches(after=int(variables.get("last_process_indexes", 0))):
+        try:
+            txs = decode_batch(batch)
+        except InvalidBatch as e:
+            print(f"Skipping batch {index} that could not be processed: {e!r}")
+            txs = []
+        replay_transactions(txs, index)
+    print(f"Caught up to index {variables.get('last_process_indexes', 0)}.")
+
+
+# Function to replay decoded transfers to update balances, recording the batch index they bring us to
+def replay_transactions(latest_transactions, index=None):
+    apply_transfers(verify_batch(latest_transactions), index)
+
+
+# Forget the batches that fell out of the dedupe window at `index`, caller holds state_lock.
+# The window only depends on the batch index, so every replica drops the same txs.
+def _prune_window(index):
+    while applied_batches and next(iter(applied_batches)) <= index - APPLIED_TX_BATCHES:
+        _, tx_ids = applied_batches.popitem(last=False)
+        for tx_id in tx_ids:
+            applied_tx_ids.pop(tx_id, None)
+
+
+# Replace the dedupe window with checkpointed (index, tx_ids) records, caller holds state_lock
+def _reset_window(window, index):
+    applied_batches.clear()
+    applied_tx_ids.clear()
+    window_changes.clear()
+    for batch_index, tx_ids in window:
+        applied_batches[batch_index] = tx_ids
+        for tx_id in tx_ids:
+            applied_tx_ids[tx_id] = batch_index
+    _prune_window(index)
+
+
+# Drop txs whose tx_id was applied in the last APPLIED_TX_BATCHES batches or earlier in this
+# one. A batch resent after an ambiguous submit failure can be sequenced twice, its copies
+# share tx_ids. Returns the fresh txs and their tx_ids.
+def drop_replayed(txs):
+    fresh = []
+    tx_ids = []
+    seen = set()
+    for tx in txs:
+        tx_id = tx.get("tx_id")
+        if tx_id is not None:
+            tx_id = str(tx_id)
+            if tx_id in applied_tx_ids or tx_id in seen:
+                print(f"Skipping replayed tx {tx_id}")
+                continue
+            seen.add(tx_id)
+            tx_ids.append(tx_id)
+        fresh.append(tx)
+    return fresh, tx_ids
+
+
+# Remember the tx_ids applied from batch `index` so checkpoints carry them, caller holds state_lock
+def _record_applied(tx_ids, index):
+    if index is None:
+        return
+    if tx_ids:
+        applied_batches[index] = tx_ids
+        for tx_id in tx_ids:
+            applied_tx_ids[tx_id] = index
+        window_changes.append((index, tx_ids))
+    _prune_window(index)
+
+
+# Apply verified transfers in sequencer order and advance the index to the batch they came from
+def apply_transfers(valid_txs, index=None):
+    valid_txs, tx_ids = drop_replayed(valid_txs)
+    if sharded_state is not None:
+        # Shards compute the batch in parallel
+        changes = sharded_state.apply(valid_txs)
+    else:
+        changes = {}
+        for tx in valid_txs:
+            _apply_transfer(changes, tx)
+    # The batch lands as one update together with its index, so a batch that fails halfway
+    # changes nothing and checkpoints always see a whole batch
+    with state_lock:
+        balances.update(changes)
+        dirty_keys.update(changes)
+        _record_applied(tx_ids, index)
+        if index is not None:
+            variables["last_process_indexes"] = index
+            if index % SYNC_SNAPSHOT_EVERY == 0:
+                take_sync_snapshot(index)
 
 
 # ERC-20 like token details
@@ -130,14 +540,46 @@ def info():
     })
 
 
+# Serve the chunk manifest of our sync snapshot to syncing peers
+@app.route('/snapshot/manifest', methods=['GET'])
+def snapshot_manifest_endpoint():
+    if not os.path.exists(SYNC_FILE):
+        abort(404)
+    return jsonify(get_snapshot_manifest())
+
+
+# Serve a single snapshot chunk by number
+@app.route('/snapshot/chunk/<int:number>', methods=['GET'])
+def snapshot_chunk(number):
+    if not os.path.exists(SYNC_FILE):
+        abort(404)
+    with open(SYNC_FILE, 'rb') as f:
+        f.seek(number * SYNC_CHUNK_SIZE)
+        buf = f.read(SYNC_CHUNK_SIZE)
+    if not buf:
+        abort(404)
+    return Response(buf, mimetype='application/octet-stream')
+
+
 # Retrieve balance of an address
 @app.route('/balance_of', methods=['GET'])
 def balance_of():
     public_key = request.args.get('public_key')
-    balance = balances.get(public_key, 0)
+    balance = get_balance(public_key)
     return jsonify({"balance": balance})
 
 
+# Cache counters of this process. Batch verification in the pool and ASGI /transfer checks run in
+# the verification workers, each with its own key cache, so their hits are not counted here.
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"keys": key_cache.stats()})
+
+
+sequencer_client = SequencerClient(BASE_URLS, APP_NAME, SUBMIT_IN_FLIGHT, SUBMIT_TIMEOUT)
+submission_pipeline = SubmissionPipeline(sequencer_client)
+
+
 # Token transfer endpoint
 @app.route('/transfer', methods=['POST'])
 def transfer():
@@ -145,83 +587,346 @@ def transfer():
     if not verify(request.form):
         return jsonify({"message": "Invalid signature"}), 403
 
-    # Randomly select a base URL from the list for this transaction
-    selected_base_url = random.choice(BASE_URLS)
-    zellular.base_url = selected_base_url  # Update the Zellular instance with the selected URL
-
     # Add the tx to Zellular sequencer
-    tx = {
-        "operation": "transfer",
-        "tx_id": str(uuid4()),  # Unique tx ID
-        "public_key": request.form['public_key'],
-        "recipient": request.form['recipient'],
-        "amount": int(request.form['amount']),
-    }
-    txs = [tx]
-    zellular.send(txs)
+    tx = build_transfer_tx(request.form)
+    # Batched with concurrent transfers, wait until the sequencer has accepted it
+    try:
+        tx_id = submission_pipeline.submit(tx).result(timeout=sequencer_client.max_wait)
+    except TimeoutError:
+        # Still queued or being retried and may yet be sequenced, a new request would duplicate it
+        return jsonify({'success': True, 'pending': True, 'tx_id': tx["tx_id"]}), 202
+    except Exception as e:
+        return jsonify({"message": f"Error submitting tx to Zellular: {e}"}), 502
 
-    return {'success': True}
+    return {'success': True, 'tx_id': tx_id}
 
 
-# Process finalized txs from the Zellular sequencer
-def process_txs():
-    while True:
-        for batch, index in zellular.batches(after=int(variables.get("last_process_indexes", 0))):
-            txs = json.loads(batch)
-            for i, tx in enumerate(txs):
-                if tx["operation"] == "transfer":
-                    _transfer(tx)  # Process each tx from the sequencer
-                else:
-                    print("Invalid transaction", tx)
-            # Update last processed index
-            variables["last_process_indexes"] = index
-        time.sleep(1)  # Adjust the interval if necessary
+#-------------------------------------
+# Asyncio (ASGI) serving mode: same endpoints, non-blocking sequencer I/O. It is only built
+# with --asgi, so fastapi, uvicorn, httpx and python-multipart are not needed otherwise.
+def create_asgi_app():
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, Response as ASGIResponse
+
+    async_submission_pipeline = AsyncSubmissionPipeline(sequencer_client)
+    asgi_app = FastAPI()
+
+    @asgi_app.on_event("startup")
+    async def start_async_pipeline():
+        await async_submission_pipeline.start()
+
+    @asgi_app.on_event("shutdown")
+    async def stop_async_pipeline():
+        await async_submission_pipeline.stop()
+
+    @asgi_app.get('/info')
+    async def async_info():
+        return {
+            "name": TOKEN_NAME,
+            "symbol": TOKEN_SYMBOL,
+            "total_supply": TOTAL_SUPPLY,
+            "decimals": TOKEN_DECIMALS
+        }
+
+    @asgi_app.get('/balance_of')
+    async def async_balance_of(public_key: str = None):
+        # Served from memory or the mapped snapshot, cheap enough to run on the loop
+        return {"balance": get_balance(public_key)}
+
+    @asgi_app.get('/snapshot/manifest')
+    async def async_snapshot_manifest():
+        if not os.path.exists(SYNC_FILE):
+            return JSONResponse({"message": "No snapshot"}, status_code=404)
+        return await asyncio.get_running_loop().run_in_executor(None, get_snapshot_manifest)
+
+    @asgi_app.get('/snapshot/chunk/{number}')
+    async def async_snapshot_chunk(number: int):
+        def read_chunk():
+            with open(SYNC_FILE, 'rb') as f:
+                f.seek(number * SYNC_CHUNK_SIZE)
+                return f.read(SYNC_CHUNK_SIZE)
+
+        buf = await asyncio.get_running_loop().run_in_executor(None, read_chunk) if os.path.exists(SYNC_FILE) else b''
+        if not buf:
+            return JSONResponse({"message": "No such chunk"}, status_code=404)
+        return ASGIResponse(buf, media_type='application/octet-stream')
+
+    @asgi_app.get('/cache/stats')
+    async def async_cache_stats():
+        return {"keys": key_cache.stats()}
+
+    @asgi_app.post('/transfer')
+    async def async_transfer(request: Request):
+        form = dict(await request.form())
+        # Signature checks are CPU bound, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(verify_pool.get(), verify, form):
+            return JSONResponse({"message": "Invalid signature"}, status_code=403)
+
+        tx = build_transfer_tx(form)
+        try:
+            tx_id = await async_submission_pipeline.submit(tx)
+        except asyncio.TimeoutError:
+            # Still queued or being retried and may yet be sequenced, a new request would duplicate it
+            return JSONResponse({'success': True, 'pending': True, 'tx_id': tx["tx_id"]}, status_code=202)
+        except Exception as e:
+            return JSONResponse({"message": f"Error submitting tx to Zellular: {e}"}, status_code=502)
+
+        return {'success': True, 'tx_id': tx_id}
+
+    return asgi_app
 
 
-def _transfer(tx):
-    if not verify(tx):
-        print("Invalid signature for transaction")
-        return
-    
+# Process finalized txs from the Zellular sequencer
+def process_txs():
+    # Decode and verify the next batches while the current one is being applied
+    BatchConsumer(
+        fetch=lambda after: zellular.batches(after=after),
+        decode=decode_batch,
+        verify=verify_batch,
+        apply=apply_transfers,
+        after=int(variables.get("last_process_indexes", 0)),
+    ).run()
+
+
+# Apply an already verified transfer to the balances changed by the current batch
+def _apply_transfer(changes, tx):
     sender_public_key = tx['public_key']
     recipient_public_key = tx['recipient']
-    amount = int(tx['amount'])
+    amount = tx['amount']
 
-    sender_balance = balances.get(sender_public_key, 0)
-    recipient_balance = balances.get(recipient_public_key, 0)
+    sender_balance = _read_balance(changes, sender_public_key)
 
     if sender_balance < amount:
         print(f"Error: insufficient funds for {sender_public_key}")
         return
 
-    # Update balances
-    balances[sender_public_key] = sender_balance - amount
-    balances[recipient_public_key] = recipient_balance + amount
+    # Update balances (the recipient is read after the debit so self-transfers are a no-op)
+    changes[sender_public_key] = sender_balance - amount
+    changes[recipient_public_key] = _read_balance(changes, recipient_public_key) + amount
 
 
-# Periodic JSON dump function based on height(txs count in this case) divisible by 100000
-def dump_json_on_height():
-    while True:
-        # Get the current height from variables
-        current_height = variables.get("height", 0)
+# Read a balance, preferring values already changed earlier in the same batch
+def _read_balance(changes, public_key):
+    if public_key in changes:
+        return changes[public_key]
+    return get_balance(public_key)
 
-        if current_height % 100000 == 0:
-            # Dump balances and variables to a JSON file
-            with open(BALANCES_FILE, 'w') as f:
-                json.dump(balances, f)
-            with open(VARIABLES_FILE, 'w') as f:
-                json.dump(variables, f)
-            print(f"Data dumped to JSON files at height {current_height}.")
 
-        # Increment height for testing purposes (this should reflect the actual network height)
-        variables["height"] = current_height + 1
-        time.sleep(1)  # Adjust the interval if necessary
+#-------------------------------------
+# Sharded state engine: accounts are partitioned by key hash across worker processes.
+# A batch is cut into rounds. In phase one every shard applies, in sequencer order, the
+# txs whose sender it owns: local transfers fully, cross-shard ones as a debit. In phase
+# two the successful debits are credited on the recipients' shards. A round ends before
+# any tx whose sender's shard still has credits pending, so every balance check sees
+# exactly the state the sequential order would give it and all replicas agree.
+
+# Shard owning an account, stable across processes, restarts and replicas
+def shard_of(public_key, shards):
+    digest = hashlib.blake2b(public_key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+# Worker loop owning one partition, unseen accounts are read from the state inherited at fork.
+# Values overwritten by the current batch are kept until the next one starts, so a batch that
+# fails halfway can be rolled back and the partition matches the main process again.
+def _shard_worker(conn):
+    accounts = {}
+    undo = {}  # Account -> value before the current batch, None if it wasn't held yet
+    current_batch = None
+
+    def read(public_key):
+        if public_key in accounts:
+            return accounts[public_key]
+        return get_balance(public_key)
+
+    def write(public_key, balance):
+        if public_key not in undo:
+            undo[public_key] = accounts.get(public_key)
+        accounts[public_key] = changed[public_key] = balance
+
+    while True:
+        command, batch, ops = conn.recv()
+        if batch != current_batch:
+            undo.clear()
+            current_batch = batch
+        changed = {}
+        if command == 'apply':
+            results = []
+            for kind, sender, recipient, amount in ops:
+                sender_balance = read(sender)
+                if sender_balance < amount:
+                    results.append(False)
+                    continue
+                write(sender, sender_balance - amount)
+                if kind == 'transfer':
+                    write(recipient, read(recipient) + amount)
+                results.append(True)
+            conn.send((results, changed))
+        elif command == 'credit':
+            for recipient, amount in ops:
+                write(recipient, read(recipient) + amount)
+            conn.send(changed)
+        elif command == 'rollback':
+            for public_key, balance in undo.items():
+                if balance is None:
+                    accounts.pop(public_key, None)
+                else:
+                    accounts[public_key] = balance
+            undo.clear()
+            conn.send('rolled back')
+
+
+class ShardedState:
+    def __init__(self, shards):
+        self.shards = shards
+        self.connections = []
+        # Workers must inherit the loaded snapshot and overlay, so they are forked
+        context = multiprocessing.get_context('fork')
+        for _ in range(shards):
+            parent_conn, child_conn = context.Pipe()
+            context.Process(target=_shard_worker, args=(child_conn,), daemon=True).start()
+            self.connections.append(parent_conn)
+        self.batches = 0  # Batches sent to the workers, tags their commands
+
+    # Apply verified transfers in sequencer order, returning the final value of every changed balance
+    def apply(self, txs):
+        # Every tx is parsed and placed before the first round runs, so a bad one fails the
+        # batch while the workers are still untouched
+        rounds = []
+        ops = [[] for _ in range(self.shards)]
+        pending_credits = set()  # Shards receiving a credit in the current round
+        for tx in txs:
+            sender, recipient, amount = tx['public_key'], tx['recipient'], int(tx['amount'])
+            sender_shard = shard_of(sender, self.shards)
+            recipient_shard = shard_of(recipient, self.shards)
+            if sender_shard in pending_credits:
+                rounds.append(ops)
+                ops = [[] for _ in range(self.shards)]
+                pending_credits.clear()
+            if sender_shard == recipient_shard:
+                ops[sender_shard].append(('transfer', sender, recipient, amount))
+            else:
+                ops[sender_shard].append(('debit', sender, recipient, amount))
+                pending_credits.add(recipient_shard)
+        rounds.append(ops)
+
+        self.batches += 1
+        changed = {}
+        try:
+            for ops in rounds:
+                self._run_round(ops, changed)
+        except BaseException:
+            # The caller drops the batch, the workers must forget it too. Replies of the
+            # failed round still in a pipe are read and discarded up to the rollback's.
+            for connection in self.connections:
+                try:
+                    connection.send(('rollback', self.batches, None))
+                    while connection.recv() != 'rolled back':
+                        pass
+                except (OSError, EOFError):
+                    pass  # A dead worker holds no state to undo
+            raise
+        return changed
+
+    def _run_round(self, ops, changed):
+        # Phase one: every shard applies its own txs in parallel
+        active = [shard for shard in range(self.shards) if ops[shard]]
+        for shard in active:
+            self.connections[shard].send(('apply', self.batches, ops[shard]))
+        credits = [[] for _ in range(self.shards)]
+        for shard in active:
+            results, shard_changed = self.connections[shard].recv()
+            changed.update(shard_changed)
+            for (kind, sender, recipient, amount), ok in zip(ops[shard], results):
+                if not ok:
+                    print(f"Error: insufficient funds for {sender}")
+                elif kind == 'debit':
+                    credits[shard_of(recipient, self.shards)].append((recipient, amount))
+
+        # Phase two: credit successful cross-shard debits on the recipients' shards
+        active = [shard for shard in range(self.shards) if credits[shard]]
+        for shard in active:
+            self.connections[shard].send(('credit', self.batches, credits[shard]))
+        for shard in active:
+            changed.update(self.connections[shard].recv())
+
+
+sharded_state = None
+
+
+# Persist state: append a delta of dirty keys, or compact everything into a full snapshot
+def checkpoint(full=False):
+    global snapshot
+    with state_lock:
+        index = variables.get("last_process_indexes", 0)
+        if full:
+            view = snapshot
+            changes = dict(balances)
+            window = list(applied_batches.items())
+        else:
+            changes = {key: get_balance(key) for key in dirty_keys}
+            window = list(window_changes)
+        dirty_keys.clear()
+        window_changes.clear()
+
+    if full:
+        # Stream the old mapping merged with newer values, without loading all accounts
+        newer_items = sorted(changes.items(), key=lambda item: item[0].encode('utf-8'))
+        write_snapshot(_merge_sorted(view.items() if view else [], newer_items), index, window)
+        new_view = SnapshotView(SNAPSHOT_FILE)
+        with state_lock:
+            # Swap first so readers never miss a value, then drop what the snapshot now holds
+            snapshot = new_view
+            for key, balance in changes.items():
+                if balances.get(key) == balance:
+                    del balances[key]
+        # Every delta so far is covered by the new snapshot
+        if os.path.exists(DELTA_FILE):
+            os.remove(DELTA_FILE)
+        print(f"Full snapshot written at index {index} ({new_view.count} accounts).")
+    elif changes or window:
+        append_delta(changes, index, window)
+        print(f"Delta checkpoint written at index {index} ({len(changes)} accounts).")
+        return True
+    return False
+
+
+# Periodic checkpoints whose cost scales with the accounts touched since the last one
+def checkpoint_loop():
+    deltas_written = 0
+    # Start from a compacted snapshot so new deltas never follow a torn record
+    if not os.path.exists(SNAPSHOT_FILE) or os.path.exists(DELTA_FILE):
+        checkpoint(full=True)
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL)  # Adjust the interval if necessary
+        if deltas_written >= FULL_SNAPSHOT_EVERY:
+            checkpoint(full=True)
+            deltas_written = 0
+        elif checkpoint():
+            deltas_written += 1
 
 
 if __name__ == '__main__':
+    # Fork the verification workers before any thread starts
+    verify_pool.start()
+    # Restore state from the latest snapshot and deltas before processing resumes
+    load_files()
+    # Optionally resync from peers first when this node has fallen behind
+    if '--catch-up' in sys.argv:
+        catch_up()
+    # Fork the shard workers once state is loaded, when more than one shard is configured. The
+    # verify pool's manager is the only thread by then and shard workers never touch its locks.
+    if STATE_SHARDS > 1:
+        sharded_state = ShardedState(STATE_SHARDS)
     # Start the transaction processing thread
     Thread(target=process_txs, daemon=True).start()
-    # Start the periodic JSON dump thread based on height
-    Thread(target=dump_json_on_height, daemon=True).start()
-    # Run the Flask app
-    app.run(debug=True)
+    # Start the periodic snapshot/delta checkpoint thread
+    Thread(target=checkpoint_loop, daemon=True).start()
+    # Run the ASGI app with --asgi, the Flask app otherwise
+    if '--asgi' in sys.argv:
+        import uvicorn
+        uvicorn.run(create_asgi_app(), host='127.0.0.1', port=5000)
+    else:
+        # The reloader would start a second process running the threads above on the same files
+        app.run(debug=True, use_reloader=False)
@@ -1,16 +1,24 @@
 from flask import Flask, request, jsonify
-from ecdsa import VerifyingKey, SECP256k1, BadSignatureError
 from zellular import Zellular, get_operators
-from threading import Thread
-from uuid import uuid4
-import base64
+from threading import Thread, Lock
+from concurrent.futures import TimeoutError
 import requests
-import time
-import json
+import asyncio
 import random
 import hashlib
 import os
+import sys
 import sqlite3
+import queue
+
+# The pipelined batch consumer, the sequencer client, the submission pipeline, the LRU cache and the
+# transfer verification are shared by the apps and live at the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from batch_consumer import BatchConsumer
+from sequencer_client import SequencerClient
+from lru_cache import LRUCache
+from token_transfers import verify, verify_batch, verify_pool, key_cache, build_transfer_tx, decode_batch
+from submission_pipeline import SubmissionPipeline, AsyncSubmissionPipeline
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
@@ -33,33 +41,59 @@ TOKEN_DECIMALS = 18
 TOTAL_SUPPLY = 1000000000 * (10 ** TOKEN_DECIMALS)  # 1 billion tokens
 
 DB_FILE = 'zelldb.sqlite'
+READ_POOL_SIZE = 8  # Read-only connections shared by /balance_of
+BALANCE_CACHE_SIZE = 100000  # Hot balances served from memory
+APPLIED_TX_BATCHES = 1000  # Batches whose tx_ids are kept to drop batches the sequencer got twice
+SUBMIT_IN_FLIGHT = 4  # Batches that may be awaiting a sequencer response at once
+SUBMIT_TIMEOUT = 10  # Seconds one operator may take to accept a batch
 
 # Initialize Zellular
 zellular = Zellular(APP_NAME, BASE_URLS[0])
 
 #-------------------------------------
+# Single long-lived write connection shared by the batch applier
+db_conn = None
+db_lock = Lock()
+
+
+# Open (once) the write connection in WAL mode with explicit transaction control
+def get_db():
+    global db_conn
+    if db_conn is None:
+        db_conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        db_conn.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL only fsyncs at checkpoints, each batch commit stays atomic
+        db_conn.execute('PRAGMA synchronous=NORMAL')
+    return db_conn
+
+
 # Initialize SQLite DB and tables
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    # Create tables for balances and variables
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS balances (
-            public_key TEXT PRIMARY KEY,
-            balance INTEGER
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS variables (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with db_lock:
+        # Create tables for balances and variables
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS balances (
+                public_key TEXT PRIMARY KEY,
+                balance INTEGER
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS variables (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+        # tx_ids of recent batches, a resent batch that got sequenced twice shares them
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS applied_txs (
+                tx_id TEXT PRIMARY KEY,
+                batch_index INTEGER
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS applied_txs_batch_index ON applied_txs (batch_index)')
 
 # Function to initialize the system
 @app.before_first_request
@@ -67,51 +101,153 @@ def initialize():
     init_db()
 
     # Load or initialize balances and variables
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    conn = get_db()
+    with db_lock:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+
+        # Check if genesis address exists, if not, initialize it with total supply
+        cursor.execute('SELECT balance FROM balances WHERE public_key=?', (GENESIS_ADDRESS,))
+        if cursor.fetchone() is None:
+            cursor.execute('INSERT INTO balances (public_key, balance) VALUES (?, ?)', (GENESIS_ADDRESS, TOTAL_SUPPLY))
+            print("Initialized genesis address with total supply.")
 
-    # Check if genesis address exists, if not, initialize it with total supply
-    cursor.execute('SELECT balance FROM balances WHERE public_key=?', (GENESIS_ADDRESS,))
-    if cursor.fetchone() is None:
-        cursor.execute('INSERT INTO balances (public_key, balance) VALUES (?, ?)', (GENESIS_ADDRESS, TOTAL_SUPPLY))
-        print("Initialized genesis address with total supply.")
+        # Check if 'last_process_indexes' exists in variables, if not, initialize it
+        cursor.execute('SELECT value FROM variables WHERE key=?', ('last_process_indexes',))
+        if cursor.fetchone() is None:
+            cursor.execute('INSERT INTO variables (key, value) VALUES (?, ?)', ('last_process_indexes', '0'))
+            print("Initialized variables with default values.")
 
-    # Check if 'last_process_indexes' exists in variables, if not, initialize it
-    cursor.execute('SELECT value FROM variables WHERE key=?', ('last_process_indexes',))
-    if cursor.fetchone() is None:
-        cursor.execute('INSERT INTO variables (key, value) VALUES (?, ?)', ('last_process_indexes', '0'))
-        print("Initialized variables with default values.")
+        cursor.execute('COMMIT')
 
-    conn.commit()
-    conn.close()
 
+# Read the index of the last batch whose txs are committed
+def get_last_index():
+    conn = get_db()
+    with db_lock:
+        row = conn.execute('SELECT value FROM variables WHERE key=?', ('last_process_indexes',)).fetchone()
+    return int(row[0]) if row else 0
 
-# Function to verify signatures
-def verify(tx):
-    message = ','.join([tx[key] for key in ['recipient', 'amount']]).encode('utf-8')
+
+# Apply every tx of a finalized batch and the new last_process_indexes in one transaction.
+# Unlike the InMemory app (STATE_SHARDS) this is not sharded across processes: most of the
+# time goes to SQLite on its single writer connection, and splitting balances over several
+# database files would lose the atomic per-batch commit, which WAL mode does not give
+# across files.
+def apply_batch(txs, index):
+    conn = get_db()
+    with db_lock:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            touched = {}  # Balances changed by this batch, written once at the end
+            for tx in txs:
+                if "tx_id" in tx:
+                    cursor.execute('INSERT OR IGNORE INTO applied_txs (tx_id, batch_index) VALUES (?, ?)',
+                                   (str(tx["tx_id"]), index))
+                    if cursor.rowcount == 0:
+                        print(f"Skipping replayed tx {tx['tx_id']}")
+                        continue
+                _apply_transfer(cursor, touched, tx)
+            cursor.execute('DELETE FROM applied_txs WHERE batch_index <= ?', (index - APPLIED_TX_BATCHES,))
+            cursor.executemany('''
+                INSERT INTO balances (public_key, balance) VALUES (?, ?)
+                ON CONFLICT(public_key) DO UPDATE SET balance=excluded.balance
+            ''', touched.items())
+            cursor.execute('UPDATE variables SET value=? WHERE key=?', (str(index), 'last_process_indexes'))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        # Only committed values ever reach the read cache
+        update_balance_cache(touched)
+    return touched
+
+
+# Pool of read-only connections so /balance_of doesn't open one per request
+read_pool = None
+read_pool_lock = Lock()
+
+
+def get_read_pool():
+    global read_pool
+    with read_pool_lock:
+        if read_pool is None:
+            read_pool = queue.Queue()
+            for _ in range(READ_POOL_SIZE):
+                conn = sqlite3.connect(f'file:{DB_FILE}?mode=ro', uri=True, check_same_thread=False)
+                read_pool.put(conn)
+    return read_pool
+
+
+# Version of the balance cache, bumped by the applier after every commit
+balance_cache_lock = Lock()
+balance_version = 0
+
+
+# Refresh cached balances with the values of a just-committed batch
+def update_balance_cache(touched):
+    global balance_version
+    with balance_cache_lock:
+        balance_version += 1
+        for public_key, balance in touched.items():
+            balance_cache.put(public_key, balance)
+
+
+# Read a committed balance, from memory when possible
+def get_balance(public_key):
+    balance = balance_cache.get(public_key)
+    if balance is not None:
+        return balance
+
+    with balance_cache_lock:
+        version = balance_version
+    pool = get_read_pool()
+    conn = pool.get()
     try:
-        public_key = base64.b64decode(tx['public_key'])
-        signature = base64.b64decode(tx['signature'])
-        vk = VerifyingKey.from_string(public_key, curve=SECP256k1)
-        vk.verify(signature, message)
-    except (BadSignatureError, ValueError):
-        return False
-    return True
+        result = conn.execute('SELECT balance FROM balances WHERE public_key=?', (public_key,)).fetchone()
+    finally:
+        pool.put(conn)
+    balance = result[0] if result else 0
+
+    # Don't cache a value read before a commit that landed in the meantime
+    with balance_cache_lock:
+        if version == balance_version:
+            balance_cache.put(public_key, balance)
+    return balance
+
+
+balance_cache = LRUCache(BALANCE_CACHE_SIZE)
+
+
+# ERC-20 like token details
+@app.route('/info', methods=['GET'])
+def info():
+    return jsonify({
+        "name": TOKEN_NAME,
+        "symbol": TOKEN_SYMBOL,
+        "total_supply": TOTAL_SUPPLY,
+        "decimals": TOKEN_DECIMALS
+    })
 
 
 # Retrieve balance of an address
 @app.route('/balance_of', methods=['GET'])
 def balance_of():
     public_key = request.args.get('public_key')
+    balance = get_balance(public_key)
+    return jsonify({"balance": balance})
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT balance FROM balances WHERE public_key=?', (public_key,))
-    result = cursor.fetchone()
-    balance = result[0] if result else 0
-    conn.close()
 
-    return jsonify({"balance": balance})
+# Cache counters of this process. Batch verification in the pool and ASGI /transfer checks run in
+# the verification workers, each with its own key cache, so their hits are not counted here.
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"keys": key_cache.stats(), "balances": balance_cache.stats()})
+
+
+sequencer_client = SequencerClient(BASE_URLS, APP_NAME, SUBMIT_IN_FLIGHT, SUBMIT_TIMEOUT)
+submission_pipeline = SubmissionPipeline(sequencer_client)
 
 
 # Token transfer endpoint
@@ -121,82 +257,129 @@ def transfer():
     if not verify(request.form):
         return jsonify({"message": "Invalid signature"}), 403
 
-    # Randomly select a base URL from the list for this transaction
-    selected_base_url = random.choice(BASE_URLS)
-    zellular.base_url = selected_base_url  # Update the Zellular instance with the selected URL
-
     # Add the tx to Zellular sequencer
-    tx = {
-        "operation": "transfer",
-        "tx_id": str(uuid4()),  # Unique tx ID
-        "public_key": request.form['public_key'],
-        "recipient": request.form['recipient'],
-        "amount": int(request.form['amount']),
-    }
-    txs = [tx]
-    zellular.send(txs)
+    tx = build_transfer_tx(request.form)
+    # Batched with concurrent transfers, wait until the sequencer has accepted it
+    try:
+        tx_id = submission_pipeline.submit(tx).result(timeout=sequencer_client.max_wait)
+    except TimeoutError:
+        # Still queued or being retried and may yet be sequenced, a new request would duplicate it
+        return jsonify({'success': True, 'pending': True, 'tx_id': tx["tx_id"]}), 202
+    except Exception as e:
+        return jsonify({"message": f"Error submitting tx to Zellular: {e}"}), 502
 
-    return {'success': True}
+    return {'success': True, 'tx_id': tx_id}
 
 
-# Process finalized txs from the Zellular sequencer
-def process_txs():
-    while True:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+#-------------------------------------
+# Asyncio (ASGI) serving mode: same endpoints, non-blocking sequencer I/O. It is only built
+# with --asgi, so fastapi, uvicorn, httpx and python-multipart are not needed otherwise.
+def create_asgi_app():
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    async_submission_pipeline = AsyncSubmissionPipeline(sequencer_client)
+    asgi_app = FastAPI()
+
+    @asgi_app.on_event("startup")
+    async def start_async_pipeline():
+        await async_submission_pipeline.start()
+
+    @asgi_app.on_event("shutdown")
+    async def stop_async_pipeline():
+        await async_submission_pipeline.stop()
+
+    @asgi_app.get('/info')
+    async def async_info():
+        return {
+            "name": TOKEN_NAME,
+            "symbol": TOKEN_SYMBOL,
+            "total_supply": TOTAL_SUPPLY,
+            "decimals": TOKEN_DECIMALS
+        }
+
+    @asgi_app.get('/balance_of')
+    async def async_balance_of(public_key: str = None):
+        # Hot balances come straight from memory, misses hit the read pool off the loop
+        balance = balance_cache.get(public_key)
+        if balance is None:
+            balance = await asyncio.get_running_loop().run_in_executor(None, get_balance, public_key)
+        return {"balance": balance}
+
+    @asgi_app.get('/cache/stats')
+    async def async_cache_stats():
+        return {"keys": key_cache.stats(), "balances": balance_cache.stats()}
+
+    @asgi_app.post('/transfer')
+    async def async_transfer(request: Request):
+        form = dict(await request.form())
+        # Signature checks are CPU bound, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(verify_pool.get(), verify, form):
+            return JSONResponse({"message": "Invalid signature"}, status_code=403)
+
+        tx = build_transfer_tx(form)
+        try:
+            tx_id = await async_submission_pipeline.submit(tx)
+        except asyncio.TimeoutError:
+            # Still queued or being retried and may yet be sequenced, a new request would duplicate it
+            return JSONResponse({'success': True, 'pending': True, 'tx_id': tx["tx_id"]}, status_code=202)
+        except Exception as e:
+            return JSONResponse({"message": f"Error submitting tx to Zellular: {e}"}, status_code=502)
+
+        return {'success': True, 'tx_id': tx_id}
+
+    return asgi_app
 
-        # Get last processed index from the database
-        cursor.execute('SELECT value FROM variables WHERE key=?', ('last_process_indexes',))
-        last_index = int(cursor.fetchone()[0])
-
-        for batch, index in zellular.batches(after=last_index):
-            txs = json.loads(batch)
-            for i, tx in enumerate(txs):
-                if tx["operation"] == "transfer":
-                    _transfer(tx)  # Process each tx from the sequencer
-                else:
-                    print("Invalid transaction", tx)
-            # Update last processed index
-            cursor.execute('UPDATE variables SET value=? WHERE key=?', (index, 'last_process_indexes'))
-
-        conn.commit()
-        conn.close()
-        time.sleep(1)  # Adjust the interval if necessary
-
-
-def _transfer(tx):
-    if not verify(tx):
-        print("Invalid signature for transaction")
-        return
 
+# Process finalized txs from the Zellular sequencer
+def process_txs():
+    # Decode and verify the next batches while the current one is being committed
+    BatchConsumer(
+        fetch=lambda after: zellular.batches(after=after),
+        decode=decode_batch,
+        verify=verify_batch,
+        apply=apply_batch,
+        after=get_last_index(),
+    ).run()
+
+
+# Apply an already verified transfer inside the current batch transaction
+def _apply_transfer(cursor, touched, tx):
     sender_public_key = tx['public_key']
     recipient_public_key = tx['recipient']
-    amount = int(tx['amount'])
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    # Get balances of sender and recipient
-    cursor.execute('SELECT balance FROM balances WHERE public_key=?', (sender_public_key,))
-    sender_balance = cursor.fetchone()[0] if cursor.fetchone() else 0
-    cursor.execute('SELECT balance FROM balances WHERE public_key=?', (recipient_public_key,))
-    recipient_balance = cursor.fetchone()[0] if cursor.fetchone() else 0
+    amount = tx['amount']
 
+    sender_balance = _read_balance(cursor, touched, sender_public_key)
     if sender_balance < amount:
         print(f"Error: insufficient funds for {sender_public_key}")
-        conn.close()
         return
 
     # Update balances
-    cursor.execute('UPDATE balances SET balance=? WHERE public_key=?', (sender_balance - amount, sender_public_key))
-    cursor.execute('UPDATE balances SET balance=? WHERE public_key=?', (recipient_balance + amount, recipient_public_key))
+    touched[sender_public_key] = sender_balance - amount
+    touched[recipient_public_key] = _read_balance(cursor, touched, recipient_public_key) + amount
+
 
-    conn.commit()
-    conn.close()
+# Read a balance, preferring values already changed earlier in the same batch
+def _read_balance(cursor, touched, public_key):
+    if public_key in touched:
+        return touched[public_key]
+    cursor.execute('SELECT balance FROM balances WHERE public_key=?', (public_key,))
+    result = cursor.fetchone()
+    return result[0] if result else 0
 
 
 if __name__ == '__main__':
+    # Fork the verification workers before any thread starts
+    verify_pool.start()
+    # Make sure tables exist before the processing thread reads the index
+    initialize()
     # Start the transaction processing thread
     Thread(target=process_txs, daemon=True).start()
-    # Run the Flask app
-    app.run(debug=True)
+    # Run the ASGI app with --asgi, the Flask app otherwise
+    if '--asgi' in sys.argv:
+        import uvicorn
+        uvicorn.run(create_asgi_app(), host='127.0.0.1', port=5000)
+    else:
+        # The reloader would start a second process running the threads above on the same files
+        app.run(debug=True, use_reloader=False)
@@ -5,11 +5,22 @@ import base64
 import requests
 import zellular
 from threading import Thread
+from concurrent.futures import TimeoutError
 import time
 import json
 import logging
+import os
+import sys
 from uuid import uuid4
 
+# The pipelined batch consumer, the sequencer client, the LRU cache and the worker pool are shared by the
+# apps and live at the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from batch_consumer import BatchConsumer, load_batch
+from sequencer_client import SequencerClient
+from lru_cache import LRUCache
+from worker_pool import WorkerPool
+
 # Initialize the Flask app and SQLAlchemy for DB interaction
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///squared.db'
@@ -19,6 +30,15 @@ db = SQLAlchemy(app)
 # Zellular configuration
 base_url = "http://5.161.230.186:6001"
 app_name = "squared_task"
+SAVE_LOOKUP_CHUNK = 500  # Numbers per IN (...) lookup, below SQLite's bound parameter limit
+RESULT_CACHE_SIZE = 100000  # Results (and task ids) served from memory by /result
+RESULTS_MAX_LOOKUPS = 1000  # task ids plus numbers accepted by one /results request
+TASK_WORKERS = os.cpu_count() or 1  # Processes computing tasks and checking their signatures
+TASK_CHUNK_SIZE = 64  # Most tasks handed to a worker at a time
+MAX_NUMBER_TO_BE_SQUARED = 3037000499  # Largest number whose square fits a 64-bit SQLite integer
+TASK_TIMEOUT = 30  # Seconds /post_task waits for a worker to compute its result
+SUBMIT_IN_FLIGHT = 8  # Tasks that may be awaiting a sequencer response at once
+SUBMIT_TIMEOUT = 10  # Seconds an operator may take to accept a task
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -27,12 +47,96 @@ logger = logging.getLogger(__name__)
 # Database model to store the number and its square
 class Square(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    number_to_be_squared = db.Column(db.Integer, nullable=False)
+    # Unique index: each number is squared once and batches dedupe against it in one lookup
+    number_to_be_squared = db.Column(db.Integer, nullable=False, unique=True, index=True)
     number_squared = db.Column(db.Integer, nullable=False)
 
+# Every task id and the number it asked for, so tasks repeating a squared number resolve too
+class Task(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.String, nullable=False, unique=True, index=True)
+    number_to_be_squared = db.Column(db.Integer, nullable=False)
+
+# Last Zellular batch index whose tasks are saved, committed together with them
+class Cursor(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    last_index = db.Column(db.Integer, nullable=False)
+
 @app.before_first_request
 def create_tables():
     db.create_all()
+    # create_all() leaves existing tables alone, so add the index to databases created before it
+    db.session.execute(db.text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_square_number_to_be_squared ON square (number_to_be_squared)"))
+    db.session.commit()
+
+# Saved results: number -> its square, and task id -> the number it asked for
+result_cache = LRUCache(RESULT_CACHE_SIZE)
+task_cache = LRUCache(RESULT_CACHE_SIZE)
+results_warmed_complete = False  # Set when warming loaded every saved result
+tasks_warmed_complete = False  # Set when warming loaded every saved task id
+
+# While nothing was evicted since a complete warm-up, a cache miss means "not saved yet"
+def result_cache_complete():
+    return results_warmed_complete and result_cache.evictions == 0
+
+def task_cache_complete():
+    return tasks_warmed_complete and task_cache.evictions == 0
+
+# Load the most recently saved results and task ids into the caches, call once before the consumer starts
+def warm_result_cache():
+    global results_warmed_complete, tasks_warmed_complete
+    rows = db.session.query(Square.number_to_be_squared, Square.number_squared) \
+        .order_by(Square.id.desc()).limit(RESULT_CACHE_SIZE + 1).all()
+    # Oldest first, so the newest results end up most recently used
+    for number_to_be_squared, number_squared in reversed(rows[:RESULT_CACHE_SIZE]):
+        result_cache.put(number_to_be_squared, number_squared)
+    results_warmed_complete = len(rows) <= RESULT_CACHE_SIZE
+    task_rows = db.session.query(Task.task_id, Task.number_to_be_squared) \
+        .order_by(Task.id.desc()).limit(RESULT_CACHE_SIZE + 1).all()
+    for task_id, number_to_be_squared in reversed(task_rows[:RESULT_CACHE_SIZE]):
+        task_cache.put(task_id, number_to_be_squared)
+    tasks_warmed_complete = len(task_rows) <= RESULT_CACHE_SIZE
+    logger.info(f"Warmed result cache with {min(len(rows), RESULT_CACHE_SIZE)} results and "
+                f"{min(len(task_rows), RESULT_CACHE_SIZE)} tasks "
+                f"({'complete' if results_warmed_complete and tasks_warmed_complete else 'partial'}).")
+
+# Resolve task ids and numbers to saved results. Served from the cache; SQLite is only
+# consulted for misses when the cache may not hold every result.
+def lookup_results(task_ids=(), numbers=()):
+    tasks = {}
+    missing_tasks = []
+    for task_id in task_ids:
+        number_to_be_squared = task_cache.get(task_id)
+        if number_to_be_squared is None:
+            missing_tasks.append(task_id)
+        else:
+            tasks[task_id] = number_to_be_squared
+    if missing_tasks and not task_cache_complete():
+        for i in range(0, len(missing_tasks), SAVE_LOOKUP_CHUNK):
+            chunk = missing_tasks[i:i + SAVE_LOOKUP_CHUNK]
+            query = db.session.query(Task.task_id, Task.number_to_be_squared).filter(Task.task_id.in_(chunk))
+            for task_id, number_to_be_squared in query:
+                tasks[task_id] = number_to_be_squared
+                task_cache.put(task_id, number_to_be_squared)
+
+    squares = {}
+    missing_numbers = []
+    for number_to_be_squared in set(numbers) | set(tasks.values()):
+        number_squared = result_cache.get(number_to_be_squared)
+        if number_squared is None:
+            missing_numbers.append(number_to_be_squared)
+        else:
+            squares[number_to_be_squared] = number_squared
+    if missing_numbers and not result_cache_complete():
+        for i in range(0, len(missing_numbers), SAVE_LOOKUP_CHUNK):
+            chunk = missing_numbers[i:i + SAVE_LOOKUP_CHUNK]
+            query = db.session.query(Square.number_to_be_squared, Square.number_squared) \
+                .filter(Square.number_to_be_squared.in_(chunk))
+            for number_to_be_squared, number_squared in query:
+                squares[number_to_be_squared] = number_squared
+                result_cache.put(number_to_be_squared, number_squared)
+    return tasks, squares
 
 # Function to verify the transaction signature
 def verify_transaction(transaction):
@@ -43,21 +147,144 @@ def verify_transaction(transaction):
         vk = VerifyingKey.from_string(public_key, curve=SECP256k1)
         vk.verify(signature, message)
         return True
-    except (BadSignatureError, ValueError) as e:
+    except (BadSignatureError, ValueError, KeyError) as e:
         logger.error(f"Signature verification failed: {e}")
         return False
 
+# Function to square a number
+def square_number(tx):
+    number_to_be_squared = int(tx["number_to_be_squared"])
+    if abs(number_to_be_squared) > MAX_NUMBER_TO_BE_SQUARED:
+        raise ValueError(f"{number_to_be_squared} is too large to square")
+    return {"number_squared": number_to_be_squared ** 2}
+
+# Operation -> function computing the result fields of a task. Handlers run in worker
+# processes, so heavier task types can be added here without blocking the HTTP server.
+TASK_HANDLERS = {
+    "square_number": square_number,
+}
+
+task_pool = WorkerPool(TASK_WORKERS)  # Processes running tasks, started in __main__
+
+# Function to check a task's signature and compute its result, None if either fails
+def run_task(tx):
+    if not verify_transaction(tx):
+        return None
+    try:
+        return TASK_HANDLERS[tx["operation"]](tx)
+    except (KeyError, ValueError, TypeError) as e:
+        logger.error(f"Task {tx.get('task_id')} failed: {e}")
+        return None
+
+# Function to run a chunk of finalized tasks inside a worker process. A result claimed by
+# the poster must match the recomputed one.
+def _run_task_chunk(txs):
+    results = []
+    for tx in txs:
+        result = run_task(tx)
+        if result is not None:
+            for key, value in result.items():
+                if key in tx and tx[key] != value:
+                    logger.error(f"Task {tx.get('task_id')} claims {key}={tx[key]}, computed {value}")
+                    result = None
+                    break
+        results.append(result)
+    return results
+
+# Run a finalized batch across the worker pool and return its valid tasks, with their
+# computed results, in sequencer order
+def execute_tasks(txs):
+    if not txs:
+        return []
+    # Spread even small batches over every worker, heavy tasks dominate the pickling cost
+    size = max(1, min(TASK_CHUNK_SIZE, -(-len(txs) // TASK_WORKERS)))
+    results = task_pool.map_chunks(_run_task_chunk, txs, size)
+    valid = []
+    for tx, result in zip(txs, results):
+        if result is None:
+            logger.error(f"Invalid transaction: {tx}")
+        else:
+            valid.append(dict(tx, **result))
+    return valid
+
+# Look up a saved result by task_id or by number
+@app.route('/result', methods=['GET'])
+def result():
+    task_id = request.args.get('task_id')
+    number_to_be_squared = request.args.get('number', type=int)
+    if task_id is None and number_to_be_squared is None:
+        return jsonify({"message": "task_id or number is required"}), 400
+
+    if task_id is not None:
+        tasks, squares = lookup_results(task_ids=[task_id])
+        number_to_be_squared = tasks.get(task_id)
+    else:
+        tasks, squares = lookup_results(numbers=[number_to_be_squared])
+    if number_to_be_squared not in squares:
+        return jsonify({"message": "Result not found"}), 404
+    return jsonify({
+        "task_id": task_id,
+        "number_to_be_squared": number_to_be_squared,
+        "number_squared": squares[number_to_be_squared],
+    })
+
+# Bulk variant of /result, takes {"task_ids": [...], "numbers": [...]}
+@app.route('/results', methods=['POST'])
+def results():
+    body = request.get_json(silent=True) or {}
+    task_ids = [str(task_id) for task_id in body.get("task_ids", [])]
+    try:
+        numbers = [int(number) for number in body.get("numbers", [])]
+    except (TypeError, ValueError):
+        return jsonify({"message": "numbers must be integers"}), 400
+    if len(task_ids) + len(numbers) > RESULTS_MAX_LOOKUPS:
+        return jsonify({"message": f"At most {RESULTS_MAX_LOOKUPS} lookups per request"}), 400
+
+    tasks, squares = lookup_results(task_ids, numbers)
+    found = []
+    missing_task_ids = []
+    for task_id in task_ids:
+        number_to_be_squared = tasks.get(task_id)
+        if number_to_be_squared in squares:
+            found.append({"task_id": task_id, "number_to_be_squared": number_to_be_squared,
+                          "number_squared": squares[number_to_be_squared]})
+        else:
+            missing_task_ids.append(task_id)
+    missing_numbers = []
+    for number_to_be_squared in numbers:
+        if number_to_be_squared in squares:
+            found.append({"task_id": None, "number_to_be_squared": number_to_be_squared,
+                          "number_squared": squares[number_to_be_squared]})
+        else:
+            missing_numbers.append(number_to_be_squared)
+    return jsonify({"results": found, "missing": {"task_ids": missing_task_ids, "numbers": missing_numbers}})
+
+# Cache sizes and hit rates of the result read path
+@app.route('/results/stats', methods=['GET'])
+def results_stats():
+    return jsonify({
+        "complete": result_cache_complete() and task_cache_complete(),
+        "results": result_cache.stats(),
+        "tasks": task_cache.stats(),
+    })
+
+# Sequencer operators to submit to, falling back to the configured node
+def get_operator_urls():
+    try:
+        operators = zellular.get_operators()
+    except Exception as e:
+        logger.warning(f"Could not fetch the operator list, using {base_url}: {e}")
+        return [base_url]
+    return [op["socket"] for op in operators.values() if "socket" in op] or [base_url]
+
+sequencer_client = SequencerClient(get_operator_urls(), app_name, SUBMIT_IN_FLIGHT, SUBMIT_TIMEOUT)
+
 # Function to post tasks to Zellular (creating squaring tasks)
 @app.route('/post_task', methods=['POST'])
 def post_task():
-    # Verify signature
-    if not verify_transaction(request.form):
-        return jsonify({"message": "Invalid signature"}), 403
-
     sender_public_key = request.form['public_key']
     task_id = request.form["task_id"]
     number_to_be_squared = int(request.form["number_to_be_squared"])
-    number_squared = number_to_be_squared ** 2
 
     # Prepare the transaction for Zellular
     tx = {
@@ -66,58 +293,128 @@ def post_task():
         "public_key": sender_public_key,
         "task_id": task_id,
         "number_to_be_squared": number_to_be_squared,
-        "number_squared": number_squared,
-        "timestamp": int(time.time())
+        "timestamp": int(time.time()),
+        "signature": request.form["signature"],
     }
 
-    # Post the transaction to Zellular
-    zresponse = requests.put(f"{base_url}/node/{app_name}/batches", json=[tx])
+    # Verify the signature and compute the result in a worker, off the request thread
+    try:
+        result = task_pool.get().submit(run_task, tx).result(timeout=TASK_TIMEOUT)
+    except TimeoutError:
+        return jsonify({"message": "Timed out computing the task"}), 504
+    if result is None:
+        return jsonify({"message": "Invalid signature"}), 403
+    tx.update(result)
+    number_squared = tx["number_squared"]
 
-    if zresponse.status_code != 200:
-        return jsonify({"message": f"Error submitting task to Zellular: {zresponse.status_code}"}), 500
+    # Post the transaction to Zellular through the healthiest operator
+    try:
+        sequencer_client.put_batch(json.dumps([tx]))
+    except RuntimeError as e:
+        return jsonify({"message": f"Error submitting task to Zellular: {e}"}), 500
 
     logger.info(f"Task {task_id} posted: {number_to_be_squared} squared is {number_squared}")
     return jsonify({"message": "Task successfully posted", "task_id": task_id})
 
+# Decode a finalized batch into the well-formed tasks we have handlers for
+def decode_tasks(batch):
+    tasks = []
+    for tx in load_batch(batch):
+        if isinstance(tx, dict) and tx.get("operation") in TASK_HANDLERS and isinstance(tx.get("task_id"), str):
+            tasks.append(tx)
+        else:
+            logger.error(f"Invalid transaction: {tx}")
+    return tasks
+
+
+# Save the verified tasks of a batch and advance the cursor past it
+def apply_tasks(txs, index):
+    with app.app_context():
+        save_tasks(txs, index)
+
+# Index of the last batch whose tasks were saved, 0 on a fresh database
+def get_last_index():
+    cursor = db.session.get(Cursor, 1)
+    return cursor.last_index if cursor else 0
+
+
 # Process finalized transactions from Zellular and store the results in the database
 def process_loop():
     verifier = zellular.Verifier(app_name, base_url)
-    last_index = 0
-
-    while True:
-        # Fetch finalized batches from Zellular
-        for batch, index in verifier.batches(after=last_index):
-            txs = json.loads(batch)
-            for tx in txs:
-                if tx.get("operation") == "square_number":
-                    process_task(tx)
-            last_index = index
-        time.sleep(1)  # Avoid tight loop
-
-# Function to process each task and save the results in the database
-def process_task(transaction):
-    if not verify_transaction(transaction):
-        logger.error(f"Invalid transaction: {transaction}")
-        return
-
-    task_id = transaction["task_id"]
-    number_to_be_squared = int(transaction["number_to_be_squared"])
-    number_squared = int(transaction["number_squared"])
-
-    # Check if the task is already processed
-    existing_task = Square.query.filter_by(number_to_be_squared=number_to_be_squared).first()
-    if existing_task:
-        logger.info(f"Task {task_id} is already processed.")
-        return
-
-    # Save the squared result to the database
-    new_task = Square(number_to_be_squared=number_to_be_squared, number_squared=number_squared)
-    db.session.add(new_task)
-    db.session.commit()
-    logger.info(f"Task {task_id}: Saved {number_to_be_squared} squared as {number_squared}.")
+    with app.app_context():
+        after = get_last_index()
+    # Fetching, decoding and executing tasks overlap with saving the previous batch
+    BatchConsumer(
+        fetch=lambda after: verifier.batches(after=after),
+        decode=decode_tasks,
+        verify=execute_tasks,
+        apply=apply_tasks,
+        after=after,
+    ).run()
+
+# Save verified tasks whose numbers were not squared yet in one transaction, along with every
+# new task id. Duplicates are found with one indexed IN (...) lookup per chunk and new rows are
+# bulk inserted. When given, the batch index is committed with them so a restart resumes after
+# this batch.
+def save_tasks(transactions, index=None):
+    tasks = {}
+    task_numbers = {}  # Task id -> number it asked for, the first use of an id wins
+    for transaction in transactions:
+        number_to_be_squared = int(transaction["number_to_be_squared"])
+        task_numbers.setdefault(str(transaction["task_id"]), number_to_be_squared)
+        if number_to_be_squared in tasks:
+            logger.info(f"Task {transaction['task_id']} is already processed.")
+            continue
+        tasks[number_to_be_squared] = transaction
+
+    try:
+        numbers = list(tasks)
+        for i in range(0, len(numbers), SAVE_LOOKUP_CHUNK):
+            chunk = numbers[i:i + SAVE_LOOKUP_CHUNK]
+            query = db.session.query(Square.number_to_be_squared).filter(Square.number_to_be_squared.in_(chunk))
+            for (number_to_be_squared,) in query:
+                logger.info(f"Task {tasks.pop(number_to_be_squared)['task_id']} is already processed.")
+        task_ids = list(task_numbers)
+        for i in range(0, len(task_ids), SAVE_LOOKUP_CHUNK):
+            chunk = task_ids[i:i + SAVE_LOOKUP_CHUNK]
+            for (task_id,) in db.session.query(Task.task_id).filter(Task.task_id.in_(chunk)):
+                del task_numbers[task_id]
+
+        db.session.bulk_insert_mappings(Square, [
+            {"number_to_be_squared": number_to_be_squared, "number_squared": int(transaction["number_squared"])}
+            for number_to_be_squared, transaction in tasks.items()
+        ])
+        db.session.bulk_insert_mappings(Task, [
+            {"task_id": task_id, "number_to_be_squared": number_to_be_squared}
+            for task_id, number_to_be_squared in task_numbers.items()
+        ])
+        if index is not None:
+            cursor = db.session.get(Cursor, 1)
+            if cursor is None:
+                db.session.add(Cursor(id=1, last_index=index))
+            else:
+                cursor.last_index = index
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # Only after the commit, so the cache never serves a result that could still roll back
+    for number_to_be_squared, transaction in tasks.items():
+        result_cache.put(number_to_be_squared, int(transaction["number_squared"]))
+    for task_id, number_to_be_squared in task_numbers.items():
+        task_cache.put(task_id, number_to_be_squared)
+    if tasks:
+        logger.info(f"Saved {len(tasks)} squared results" + (f" up to batch {index}." if index is not None else "."))
 
 if __name__ == '__main__':
+    # Fork the task workers before any thread starts
+    task_pool.start()
+    with app.app_context():
+        create_tables()
+        warm_result_cache()
     # Start the background process to listen for finalized transactions from Zellular
     Thread(target=process_loop).start()
     # Start the Flask app
-    app.run(debug=True)
+    # The reloader would start a second process running the threads above on the same files
+    app.run(debug=True, use_reloader=False)
@@ -1,108 +1,202 @@
-import time
+import io
+import os
+import sys
 import json
-import requests
+import time
+import base64
 import random
-import string
-
-# Initialize balances with a Genesis Address
-balance = {"GENESIS": 1000000000}
-processed_transactions = []
-batch_size = 100  # Number of transactions to send in one batch
-
-# ECDSA transaction verification function (stubbed for simplicity)
-def verify_transaction(transaction_data, signature, public_key):
-    # Assuming all transactions are valid for this test
-    return True
-
-# Sending batch transactions to the server
-def send_batch_to_server(batch_transactions):
-    try:
-        response = requests.post("http://127.0.0.1:8000/echo", json=batch_transactions)
-        return response.json()
-    except Exception as e:
-        print(f"Error sending batch transactions to server: {e}")
-        return None
-
-# Adding transaction to in-memory storage and updating balances
-def process_transaction(transaction_data):
-    sender = transaction_data["from"]
-    recipient = transaction_data["to"]
-    amount = transaction_data["amount"]
-
-    # Ensure sender has enough balance
-    if balance.get(sender, 0) >= amount:
-        # Update balance for sender and recipient
-        balance[sender] = balance.get(sender, 0) - amount
-        balance[recipient] = balance.get(recipient, 0) + amount
-
-        # Store the processed transaction
-        processed_transactions.append(transaction_data)
-    else:
-        print(f"Transaction from {sender} to {recipient} for {amount} tokens rejected: Insufficient balance.")
-
-# Generate a new address
-def generate_address():
-    return ''.join(random.choices(string.ascii_uppercase, k=5))
-
-# Generate sample transaction data
-def generate_sample_transaction():
-    sender = generate_address()
-    recipient = generate_address()
-    amount = random.randint(1, 100)
-
-    # If sender doesn't exist in balance, initialize it with zero
-    if sender not in balance:
-        balance[sender] = 0
-    if recipient not in balance:
-        balance[recipient] = 0
-
-    return {
-        "data": f"Transfer {amount} tokens from {sender} to {recipient}",
-        "from": sender,
-        "to": recipient,
-        "amount": amount
-    }
-
-# Performance testing function
-def performance_test(signature, public_key, batch_size=100):
-    # Step 1: Generate a batch of transactions, using the Genesis Address as the primary funder
-    batch_transactions = []
-    for _ in range(batch_size):
-        # Use Genesis as the sender for initial transactions if needed
-        transaction_data = generate_sample_transaction()
-        transaction_data["from"] = "GENESIS"
-        
-        # Only add valid transactions with sufficient balance to the batch
-        if balance["GENESIS"] >= transaction_data["amount"]:
-            if verify_transaction(transaction_data['data'], signature, public_key):
-                batch_transactions.append(transaction_data)
-
-    # Step 2: Send the batch to the server
-    start_time = time.time()
-    response = send_batch_to_server(batch_transactions)
-
-    # Step 3: Process each transaction in the received batch
-    if response:
-        for transaction in response["data"]:
-            process_transaction(transaction)
-
-    # Calculate performance
-    elapsed_time = time.time() - start_time
-    print(f"Processed {len(processed_transactions)} transactions in {elapsed_time:.2f} seconds.")
-    print(f"Transactions per second: {len(processed_transactions) / elapsed_time:.2f}")
-
-    # Save processed transactions and balances to a file
-    with open("processed_transactions.json", "w") as file:
-        json.dump(processed_transactions, file, indent=4)
-    with open("balances.json", "w") as file:
-        json.dump(balance, file, indent=4)
-
-    print("Processed transactions saved to 'processed_transactions.json'.")
-    print("Balances saved to 'balances.json'.")
-
-# Example signature and public key (stubbed for simplicity)
-signature = "3045022100e8b5b9a1e8a73bf7f0c3ae3d77d8f62e41ad3cda4a67db2f5f01236496a0ed9c02206d98e42c12ab11f1f9b358e80b03b9b514cd4ba93513b3c2e34fd272b3571b38"
-public_key = "04bfcf0e7ca431899b324be76b89ac9815cda5fdf31b7a60a69c4bcb5fda59d9e8f19f622f1f7adfd1c65e988d148d4e67a740d4b9b94ac96f9c0b44631569b3d8"
-
-# Run the performance test
-performance_test(signature, public_key, batch_size=batch_size)
+import resource
+import argparse
+import tempfile
+import contextlib
+from threading import Thread, Event
+from ecdsa import SigningKey, SECP256k1
+
+import sequencer_standin
+
+# End-to-end throughput benchmark of the InMemory token app, entirely local:
+#   submit: concurrent clients POST signed transfers to /transfer (Flask test client), the
+#           app verifies them and batches them to a stand-in sequencer over HTTP
+#   replay: the finalized batches are consumed through the app's decode -> verify -> apply
+#           pipeline, then once more stage by stage to break down where the time goes
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+TOKEN_APP = os.path.join(ROOT, 'FungibleTokenStandard', 'InMemory', 'app.py')
+FUNDING = 10 ** 30  # Starting balance of every benchmark account
+REPLAY_TIMEOUT = 600  # Seconds the pipelined replay may take before the run is aborted
+
+
+# Generate signed transfer forms between the benchmark accounts, as a wallet would post them
+def generate_transfers(count, keys):
+    public_keys = [base64.b64encode(sk.get_verifying_key().to_string()).decode() for sk in keys]
+    forms = []
+    for i in range(count):
+        sender = random.randrange(len(keys))
+        recipient = public_keys[(sender + 1 + random.randrange(len(keys) - 1)) % len(keys)]
+        amount = random.randint(1, 100)
+        message = ','.join([recipient, str(amount)]).encode('utf-8')
+        forms.append({
+            "public_key": public_keys[sender],
+            "recipient": recipient,
+            "amount": str(amount),
+            "signature": base64.b64encode(keys[sender].sign(message)).decode(),
+        })
+    return forms, public_keys
+
+
+# Value at the given percentile of already sorted samples
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+# CPU seconds used so far by this process and by its reaped children (the verify pool)
+def cpu_times():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+# Drive /transfer from `concurrency` threads for `duration` seconds
+def run_submit(token, forms, concurrency, duration):
+    stop = Event()
+    latencies = [[] for _ in range(concurrency)]
+    failures = [0] * concurrency
+
+    def client(worker):
+        test_client = token.app.test_client()
+        position = worker
+        while not stop.is_set():
+            form = forms[position % len(forms)]
+            position += concurrency
+            start = time.perf_counter()
+            response = test_client.post('/transfer', data=form)
+            if response.status_code == 200:
+                latencies[worker].append(time.perf_counter() - start)
+            else:
+                failures[worker] += 1
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    threads = [Thread(target=client, args=(worker,), daemon=True) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    return sorted(latency for samples in latencies for latency in samples), sum(failures), elapsed, cpu
+
+
+# Consume every batch through the app's pipelined BatchConsumer and time it
+def run_pipelined_replay(token, last_index):
+    consumer = token.BatchConsumer(
+        fetch=lambda after: sequencer_standin.sequencer.after(after),
+        decode=token.decode_batch,
+        verify=token.verify_batch,
+        apply=token.apply_transfers,
+        min_poll=0.001,
+    )
+    start = time.perf_counter()
+    Thread(target=consumer.run, daemon=True).start()
+    while token.variables.get("last_process_indexes") != last_index:
+        if time.perf_counter() - start > REPLAY_TIMEOUT:
+            raise RuntimeError("Pipelined replay did not finish")
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+# Shut the verify pool down, its workers' CPU only shows up in RUSAGE_CHILDREN once they exit
+def stop_verify_pool(token):
+    token.verify_pool.shutdown()
+
+
+# Run decode, verify and apply one after another over every batch, timing each stage
+def run_staged_replay(token, batches):
+    stages = {name: {"wall": 0.0, "cpu": 0.0} for name in ["decode", "verify", "apply"]}
+
+    def timed(name, function, *args):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = function(*args)
+        stages[name]["wall"] += time.perf_counter() - wall
+        stages[name]["cpu"] += time.process_time() - cpu
+        return result
+
+    stop_verify_pool(token)
+    _, children_before = cpu_times()
+    for batch, index in batches:
+        txs = timed("decode", token.decode_batch, batch)
+        valid_txs = timed("verify", token.verify_batch, txs)
+        timed("apply", token.apply_transfers, valid_txs, index)
+    stop_verify_pool(token)
+    _, children_after = cpu_times()
+    stages["verify"]["cpu"] += children_after - children_before
+    return stages
+
+
+# Reset balances and replay protection so a second replay applies the same batches again
+def reset_state(token, public_keys):
+    with token.state_lock:
+        token.balances.clear()
+        token.balances.update({public_key: FUNDING for public_key in public_keys})
+        token.dirty_keys.clear()
+        token.variables.clear()
+        token._reset_window([], 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of the InMemory token app")
+    parser.add_argument('--concurrency', type=int, default=32, help="Client threads posting /transfer")
+    parser.add_argument('--batch-size', type=int, default=500, help="Transfers per sequencer batch")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of submit load")
+    parser.add_argument('--accounts', type=int, default=100, help="Distinct signing accounts")
+    parser.add_argument('--signed', type=int, default=5000, help="Pre-signed transfers cycled by the clients")
+    parser.add_argument('--sequencer-delay', type=float, default=0, help="Seconds the stand-in takes per batch")
+    args = parser.parse_args()
+
+    print(f"Signing {args.signed} transfers from {args.accounts} accounts...")
+    keys = [SigningKey.generate(curve=SECP256k1) for _ in range(args.accounts)]
+    forms, public_keys = generate_transfers(args.signed, keys)
+
+    # The app writes its snapshot files to the working directory, keep them out of the tree
+    os.chdir(tempfile.mkdtemp(prefix="zellular-tps-"))
+    sequencer_standin.serve(delay=args.sequencer_delay)
+    with contextlib.redirect_stdout(io.StringIO()):
+        token = sequencer_standin.load_app(TOKEN_APP, 'token_app')
+    token.submission_pipeline = token.SubmissionPipeline(token.sequencer_client, batch_size=args.batch_size)
+    reset_state(token, public_keys)
+
+    print(f"Submitting for {args.duration}s with {args.concurrency} clients, batch size {args.batch_size}...")
+    latencies, failures, elapsed, cpu = run_submit(token, forms, args.concurrency, args.duration)
+    batches = list(sequencer_standin.sequencer.after(0))
+    sequenced = sum(len(json.loads(batch)) for batch, _ in batches)
+    print("\nSubmit path (/transfer -> sequencer)")
+    print(f"  accepted      {len(latencies)} txs, {failures} failed, {len(batches)} batches, {sequenced} sequenced")
+    print(f"  throughput    {len(latencies) / elapsed:.0f} tx/s")
+    print(f"  latency ms    p50 {percentile(latencies, 0.5) * 1e3:.2f}  p90 {percentile(latencies, 0.9) * 1e3:.2f}  "
+          f"p99 {percentile(latencies, 0.99) * 1e3:.2f}  max {percentile(latencies, 1.0) * 1e3:.2f}")
+    print(f"  cpu           {cpu:.2f}s over {elapsed:.2f}s, {cpu / max(len(latencies), 1) * 1e6:.0f} us/tx")
+    if not batches:
+        return 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipelined = run_pipelined_replay(token, batches[-1][1])
+        reset_state(token, public_keys)
+        stages = run_staged_replay(token, batches)
+    print("\nReplay path (decode -> verify -> apply)")
+    print(f"  pipelined     {sequenced / pipelined:.0f} tx/s ({sequenced} txs in {pipelined:.2f}s)")
+    total = sum(stage["wall"] for stage in stages.values())
+    print(f"  staged        {sequenced / max(total, 1e-9):.0f} tx/s")
+    for name, stage in stages.items():
+        print(f"    {name:<8} wall {stage['wall']:.3f}s ({stage['wall'] / max(total, 1e-9):.0%})  "
+              f"cpu {stage['cpu']:.3f}s  {stage['cpu'] / max(sequenced, 1) * 1e6:.1f} us/tx")
+    print("\nSequencer operators")
+    for base_url, health in token.sequencer_client.stats().items():
+        print(f"  {base_url}  latency {health['latency'] * 1e3:.2f}ms  error rate {health['error_rate']:.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
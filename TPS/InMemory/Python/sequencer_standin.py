@@ -0,0 +1,113 @@
+import sys
+import json
+import time
+import types
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process stand-in for the zellular package so the apps can be imported and driven
+# without a sequencer network. Batches sent through it are finalized immediately.
+STANDIN_URL = "http://127.0.0.1:6001"  # Advertised operator socket until serve() binds a real one
+
+
+class StandinSequencer:
+    def __init__(self):
+        self.url = STANDIN_URL
+        self.batches = []
+        self.lock = Lock()
+
+    # Append a batch (the raw JSON text an app would PUT) and return its index
+    def append(self, batch):
+        with self.lock:
+            self.batches.append(batch)
+            return len(self.batches)
+
+    # Yield (batch, index) for every batch after the given index
+    def after(self, after):
+        with self.lock:
+            batches = self.batches[after:]
+        for offset, batch in enumerate(batches):
+            yield batch, after + offset + 1
+
+
+sequencer = StandinSequencer()
+
+
+class Zellular:
+    def __init__(self, app_name, base_url):
+        self.app_name = app_name
+        self.base_url = base_url
+
+    def send(self, txs):
+        return sequencer.append(json.dumps(txs))
+
+    def batches(self, after=0):
+        return sequencer.after(after)
+
+
+class Verifier(Zellular):
+    pass
+
+
+def get_operators():
+    return {"standin": {"socket": sequencer.url}}
+
+
+# Accepts PUT /node/<app>/batches like an operator, each body becomes one finalized batch
+class BatchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like a real operator behind the apps' session pools
+    disable_nagle_algorithm = True  # Headers and body are separate writes, avoid delayed-ACK stalls
+    delay = 0
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "node" or parts[2] != "batches":
+            self._reply(404, b'{"message": "not found"}')
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        index = sequencer.append(body.decode("utf-8"))
+        self._reply(200, json.dumps({"index": index}).encode())
+
+    def _reply(self, status, payload):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the operator endpoint on a free local port and advertise it through get_operators()
+def serve(delay=0):
+    handler = type("DelayedBatchHandler", (BatchHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    sequencer.url = f"http://127.0.0.1:{server.server_address[1]}"
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Register the stand-in as the `zellular` module, must run before an app is imported
+def install():
+    module = types.ModuleType("zellular")
+    module.Zellular = Zellular
+    module.Verifier = Verifier
+    module.get_operators = get_operators
+    module.sequencer = sequencer
+    sys.modules["zellular"] = module
+    return module
+
+
+# Import an app script by path under its own module name
+def load_app(path, name):
+    import importlib.util
+    install()
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,90 @@
+from threading import Thread
+import queue
+import json
+import time
+
+# Pipelined consumer of finalized Zellular batches, shared by the apps in this repository.
+# The apps run as standalone scripts, they put the repository root on sys.path to import it.
+CONSUMER_QUEUE_SIZE = 8  # Batches buffered between consumer pipeline stages
+CONSUMER_MIN_POLL = 0.05  # Seconds before polling again right after batches arrived
+CONSUMER_MAX_POLL = 5  # Upper bound of the idle polling backoff
+
+
+# Raised by a decode stage for a batch whose own content can't be processed. Every replica
+# hits it on the same batch, so the batch is skipped instead of stopping the node. Anything
+# else (a bug, a broken worker pool, a full disk, a locked database) is a local failure and
+# stops the consumer. Decoders drop malformed txs, so applying what is left can't fail on content.
+class InvalidBatch(ValueError):
+    pass
+
+
+# Parse a JSON batch into its list of txs
+def load_batch(batch):
+    try:
+        txs = json.loads(batch)
+    except ValueError as e:
+        raise InvalidBatch(f"Batch is not valid JSON: {e}") from e
+    if not isinstance(txs, list):
+        raise InvalidBatch(f"Batch is a {type(txs).__name__}, not a list of txs")
+    return txs
+
+
+# Streams sequencer batches through fetch -> decode -> verify -> apply stages, each on its
+# own thread. Bounded queues between stages give backpressure, so fetching the next batch
+# overlaps with decoding, verifying and applying the current one. Polling backs off while
+# the sequencer is idle and resumes at full speed as soon as batches arrive.
+class BatchConsumer:
+    def __init__(self, fetch, decode, verify, apply, after=0, queue_size=CONSUMER_QUEUE_SIZE,
+                 min_poll=CONSUMER_MIN_POLL, max_poll=CONSUMER_MAX_POLL):
+        self.fetch = fetch  # fetch(after) -> iterable of (batch, index)
+        self.decode = decode
+        self.verify = verify
+        self.apply = apply  # apply(verified, index), runs on the thread calling run()
+        self.after = after
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.fetched = queue.Queue(maxsize=queue_size)
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.verified = queue.Queue(maxsize=queue_size)
+
+    def run(self):
+        Thread(target=self._fetch_loop, daemon=True).start()
+        Thread(target=self._stage, args=(self.decode, self.fetched, self.decoded), daemon=True).start()
+        Thread(target=self._stage, args=(self.verify, self.decoded, self.verified), daemon=True).start()
+        while True:
+            index, payload, error = self.verified.get()
+            if error is None:
+                self.apply(payload, index)
+                continue
+            if not isinstance(error, InvalidBatch):
+                raise error
+            # Applying nothing still advances the index, so a restart doesn't fetch the batch again
+            print(f"Skipping batch {index} that could not be processed: {error!r}")
+            self.apply([], index)
+
+    def _fetch_loop(self):
+        last_index = self.after
+        delay = self.min_poll
+        while True:
+            fetched = False
+            try:
+                for batch, index in self.fetch(last_index):
+                    # Blocks while downstream stages are full
+                    self.fetched.put((index, batch, None))
+                    last_index = index
+                    fetched = True
+            except Exception as e:
+                print(f"Error fetching batches after {last_index}: {e}")
+            delay = self.min_poll if fetched else min(delay * 2, self.max_poll)
+            time.sleep(delay)
+
+    # Run one stage, handing failures downstream so they surface in run() in batch order
+    def _stage(self, function, source, target):
+        while True:
+            index, payload, error = source.get()
+            if error is None:
+                try:
+                    payload = function(payload)
+                except Exception as e:
+                    error = e
+            target.put((index, payload, error))
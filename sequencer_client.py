@@ -0,0 +1,142 @@
+from threading import Lock, BoundedSemaphore
+import asyncio
+import random
+import time
+import requests
+
+# Health-aware client for submitting batches to Zellular sequencer operators, shared by the apps
+# in this repository. The apps run as standalone scripts, they put the repository root on
+# sys.path to import it.
+SEQUENCER_ATTEMPTS = 3  # Operators tried, best first, before a batch submission fails
+SEQUENCER_CONNECT_TIMEOUT = 1  # Seconds to connect to an operator, a dead one fails over quickly
+SEQUENCER_EWMA_ALPHA = 0.2  # Weight of the newest sample in operator latency and error-rate averages
+SEQUENCER_ERROR_PENALTY = 10  # How strongly the error rate inflates an operator's latency score
+SEQUENCER_MAX_FAILURES = 3  # Consecutive failures before an operator is benched
+SEQUENCER_COOLDOWN = 5  # Seconds a benched operator is only tried as a last resort
+SEQUENCER_EXPLORE = 0.05  # Share of batches sent to a random healthy operator to refresh its stats
+
+
+# Submits batches to sequencer operators, routing by the health it observes. Every operator
+# has its own keep-alive session pool and EWMAs of latency and error rate. A batch goes to
+# the best scoring operator and fails over down the ranking on error. Operators that keep
+# failing are benched for a cool-down. Retries resend the same body, so every tx keeps its
+# tx_id and the apps drop a tx that ends up sequenced twice when they apply it.
+class SequencerClient:
+    def __init__(self, base_urls, app_name, max_in_flight, timeout):
+        self.base_urls = list(base_urls)
+        self.app_name = app_name
+        self.timeout = timeout  # Seconds one operator may take to accept a batch
+        self.max_in_flight = max_in_flight
+        # Longest a put_batch can take: every attempt of the retry budget
+        self.max_wait = SEQUENCER_ATTEMPTS * (SEQUENCER_CONNECT_TIMEOUT + timeout)
+        self.sessions = {}
+        for base_url in self.base_urls:
+            session = requests.Session()
+            session.mount(base_url, requests.adapters.HTTPAdapter(pool_maxsize=max_in_flight))
+            self.sessions[base_url] = session
+        self.latency = {base_url: 0.0 for base_url in self.base_urls}  # Seconds, 0 until the first sample
+        self.error_rate = {base_url: 0.0 for base_url in self.base_urls}
+        self.failures = {base_url: 0 for base_url in self.base_urls}  # Consecutive failures
+        self.benched_until = {base_url: 0.0 for base_url in self.base_urls}
+        self.lock = Lock()
+        self.in_flight = BoundedSemaphore(max_in_flight)
+        self.async_client = None
+        self.async_in_flight = None
+
+    # Operators in the order to try them: healthy ones by latency inflated by their error
+    # rate, benched ones last. Now and then a random healthy operator goes first, so one
+    # that has recovered gets fresh samples.
+    def ranked(self):
+        now = time.time()
+        with self.lock:
+            ranking = sorted(self.base_urls, key=lambda base_url: (
+                self.benched_until[base_url] > now,
+                self.latency[base_url] * (1 + SEQUENCER_ERROR_PENALTY * self.error_rate[base_url]),
+                random.random(),  # Spread load while operators have no samples yet
+            ))
+        healthy = [base_url for base_url in ranking if self.benched_until[base_url] <= now]
+        if len(healthy) > 1 and random.random() < SEQUENCER_EXPLORE:
+            explore = random.choice(healthy[1:])
+            ranking.remove(explore)
+            ranking.insert(0, explore)
+        return ranking
+
+    # Fold one submission outcome into the operator's averages
+    def record(self, base_url, elapsed, ok):
+        with self.lock:
+            # A failure counts as a full timeout, fast refusals must not look like a fast operator
+            sample = elapsed if ok else self.timeout
+            if self.latency[base_url] == 0:
+                self.latency[base_url] = sample
+            else:
+                self.latency[base_url] += SEQUENCER_EWMA_ALPHA * (sample - self.latency[base_url])
+            self.error_rate[base_url] += SEQUENCER_EWMA_ALPHA * ((0 if ok else 1) - self.error_rate[base_url])
+            if ok:
+                self.failures[base_url] = 0
+                return
+            self.failures[base_url] += 1
+            if self.failures[base_url] >= SEQUENCER_MAX_FAILURES:
+                self.failures[base_url] = 0
+                self.benched_until[base_url] = time.time() + SEQUENCER_COOLDOWN
+
+    # Operator health as seen by this client
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {base_url: {
+                "latency": self.latency[base_url],
+                "error_rate": self.error_rate[base_url],
+                "benched": self.benched_until[base_url] > now,
+            } for base_url in self.base_urls}
+
+    # Submit one serialized batch, blocking while max_in_flight batches are outstanding.
+    # Returns the operator that accepted it.
+    def put_batch(self, body):
+        errors = []
+        with self.in_flight:
+            for base_url in self.ranked()[:SEQUENCER_ATTEMPTS]:
+                start = time.time()
+                try:
+                    response = self.sessions[base_url].put(
+                        f"{base_url}/node/{self.app_name}/batches", data=body,
+                        headers={"Content-Type": "application/json"},
+                        timeout=(SEQUENCER_CONNECT_TIMEOUT, self.timeout))
+                    response.raise_for_status()
+                except Exception as e:
+                    self.record(base_url, time.time() - start, False)
+                    errors.append(f"{base_url}: {e}")
+                    continue
+                self.record(base_url, time.time() - start, True)
+                return base_url
+        raise RuntimeError(f"No sequencer operator accepted the batch ({'; '.join(errors)})")
+
+    # Async variant of put_batch for the ASGI serving mode, must run inside the serving loop.
+    # httpx is only needed by that mode, so it is imported on first use.
+    async def aput_batch(self, body):
+        if self.async_client is None:
+            import httpx
+            self.async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=SEQUENCER_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_keepalive_connections=self.max_in_flight * len(self.base_urls)))
+            self.async_in_flight = asyncio.Semaphore(self.max_in_flight)
+        errors = []
+        async with self.async_in_flight:
+            for base_url in self.ranked()[:SEQUENCER_ATTEMPTS]:
+                start = time.time()
+                try:
+                    response = await self.async_client.put(
+                        f"{base_url}/node/{self.app_name}/batches", content=body,
+                        headers={"Content-Type": "application/json"})
+                    response.raise_for_status()
+                except Exception as e:
+                    self.record(base_url, time.time() - start, False)
+                    errors.append(f"{base_url}: {e}")
+                    continue
+                self.record(base_url, time.time() - start, True)
+                return base_url
+        raise RuntimeError(f"No sequencer operator accepted the batch ({'; '.join(errors)})")
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
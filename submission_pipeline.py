@@ -0,0 +1,120 @@
+from threading import Thread, Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import queue
+import json
+import time
+
+# Coalescing of submitted txs into sequencer batches (threaded and asyncio), shared by the token apps.
+# The apps run as standalone scripts, they put the repository root on sys.path to import it.
+SUBMIT_BATCH_SIZE = 500  # Txs coalesced into one sequencer request
+SUBMIT_LINGER = 0.01  # Seconds to wait for more txs before sending a partial batch
+
+
+# Coalesces txs into batches and hands them to the sequencer client
+class SubmissionPipeline:
+    def __init__(self, client, batch_size=SUBMIT_BATCH_SIZE, linger=SUBMIT_LINGER):
+        self.client = client
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = queue.Queue()
+        self.senders = ThreadPoolExecutor(max_workers=client.max_in_flight)
+        self.collector = None  # Started by the first submit, importing an app starts no threads
+        self.lock = Lock()
+
+    # Queue a tx, the returned future resolves to its tx_id once the sequencer accepts its batch
+    def submit(self, tx):
+        if self.collector is None:
+            with self.lock:
+                if self.collector is None:
+                    self.collector = Thread(target=self._collect, daemon=True)
+                    self.collector.start()
+        future = Future()
+        self.queue.put((tx, future))
+        return future
+
+    # Gather txs until the batch is full or the linger time is up, then hand it to a sender
+    def _collect(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = time.time() + self.linger
+            while len(pending) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.senders.submit(self._send, pending)
+
+    def _send(self, pending):
+        txs = [tx for tx, _ in pending]
+        try:
+            self.client.put_batch(json.dumps(txs))
+        except Exception as e:
+            print(f"Error submitting {len(txs)} txs: {e}")
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        for tx, future in pending:
+            future.set_result(tx["tx_id"])
+
+
+# Async counterpart of SubmissionPipeline used by the ASGI serving mode
+class AsyncSubmissionPipeline:
+    def __init__(self, client, batch_size=SUBMIT_BATCH_SIZE, linger=SUBMIT_LINGER):
+        self.client = client
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = None
+        self.in_flight = None
+        self.collector = None
+
+    # Must run inside the serving event loop
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.in_flight = asyncio.Semaphore(self.client.max_in_flight)
+        self.collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        self.collector.cancel()
+        await self.client.aclose()
+
+    # Queue a tx and wait for its tx_id once the sequencer accepts its batch
+    async def submit(self, tx):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tx, future))
+        return await asyncio.wait_for(future, self.client.max_wait)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.linger
+            while len(pending) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self.in_flight.acquire()
+            asyncio.create_task(self._send(pending))
+
+    async def _send(self, pending):
+        txs = [tx for tx, _ in pending]
+        try:
+            await self.client.aput_batch(json.dumps(txs))
+        except Exception as e:
+            print(f"Error submitting {len(txs)} txs: {e}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.in_flight.release()
+        for tx, future in pending:
+            if not future.done():
+                future.set_result(tx["tx_id"])
@@ -0,0 +1,98 @@
+from ecdsa import VerifyingKey, SECP256k1, BadSignatureError
+from uuid import uuid4
+from batch_consumer import load_batch
+from lru_cache import LRUCache
+from worker_pool import WorkerPool
+import base64
+import time
+import os
+
+# Transfer signing and verification shared by the token apps (FungibleTokenStandard/InMemory
+# and Storage). The apps run as standalone scripts, they put the repository root on sys.path
+# to import it.
+VERIFY_WORKERS = os.cpu_count() or 1  # Processes used to check batch signatures
+VERIFY_CHUNK_SIZE = 256  # Txs handed to a verification worker at a time
+KEY_CACHE_SIZE = 10000  # Parsed public keys kept for repeat signers
+
+verify_pool = WorkerPool(VERIFY_WORKERS)  # Processes checking batch signatures, started by the app's __main__
+key_cache = LRUCache(KEY_CACHE_SIZE)  # Per process, every verify pool worker has its own copy
+
+
+# Return the parsed VerifyingKey for raw public key bytes, skipping point decompression for repeat signers
+def get_verifying_key(public_key):
+    vk = key_cache.get(public_key)
+    if vk is None:
+        vk = VerifyingKey.from_string(public_key, curve=SECP256k1)
+        key_cache.put(public_key, vk)
+    return vk
+
+
+# Function to verify signatures
+def verify(tx):
+    try:
+        message = ','.join([str(tx[key]) for key in ['recipient', 'amount']]).encode('utf-8')
+        public_key = base64.b64decode(tx['public_key'])
+        signature = base64.b64decode(tx['signature'])
+        vk = get_verifying_key(public_key)
+        vk.verify(signature, message)
+    except (BadSignatureError, ValueError, KeyError):
+        return False
+    return True
+
+
+# Function to verify a chunk of txs inside a worker process
+def _verify_chunk(txs):
+    return [verify(tx) for tx in txs]
+
+
+# Function to verify a whole decoded batch in parallel and keep only valid txs in sequencer order
+def verify_batch(txs):
+    start_time = time.time()
+    if len(txs) < VERIFY_CHUNK_SIZE:
+        # Small batches are cheaper to check inline than to ship to the pool
+        results = _verify_chunk(txs)
+    else:
+        results = verify_pool.map_chunks(_verify_chunk, txs, VERIFY_CHUNK_SIZE)
+    valid_txs = [tx for tx, ok in zip(txs, results) if ok]
+
+    elapsed_time = time.time() - start_time
+    if txs:
+        print(f"Verified {len(txs)} txs ({len(txs) - len(valid_txs)} invalid) in {elapsed_time:.3f}s: "
+              f"{len(txs) / max(elapsed_time, 1e-9):.0f} tx/s with {VERIFY_WORKERS} workers")
+    return valid_txs
+
+
+# Function to check that a decoded tx is a well-formed transfer, so applying it can't fail on its content
+def is_transfer(tx):
+    return (isinstance(tx, dict) and tx.get("operation") == "transfer"
+            and all(isinstance(tx.get(key), str) for key in ("public_key", "recipient", "signature"))
+            and isinstance(tx.get("tx_id", ""), str)
+            and type(tx.get("amount")) is int and tx["amount"] >= 0)
+
+
+# Function to keep the well-formed transfers of a decoded batch in sequencer order
+def filter_transfers(txs):
+    transfers = []
+    for tx in txs:
+        if is_transfer(tx):
+            transfers.append(tx)
+        else:
+            print("Invalid transaction", tx)
+    return transfers
+
+
+# Decode a sequencer batch into its transfer txs
+def decode_batch(batch):
+    return filter_transfers(load_batch(batch))
+
+
+# Build the sequencer tx for a verified transfer request
+def build_transfer_tx(form):
+    return {
+        "operation": "transfer",
+        "tx_id": str(uuid4()),  # Unique tx ID
+        "public_key": form['public_key'],
+        "recipient": form['recipient'],
+        "amount": int(form['amount']),
+        "signature": form['signature'],
+    }
@@ -0,0 +1,41 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# Process pool for CPU-bound batch work (signature checks, task computation), shared by the
+# apps in this repository. The apps run as standalone scripts, they put the repository root
+# on sys.path to import it.
+
+
+# Forked process pool that is started once at startup and fed whole batches in chunks
+class WorkerPool:
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = None
+
+    # Start the pool and fork all its workers now. Called at startup before any thread runs,
+    # so no worker inherits a lock (caches, stdout, logging) held by another thread. Fork is
+    # pinned so workers share the imported app instead of importing it again.
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+        # The first task forks every worker, before the pool starts its management thread
+        self.executor.submit(int).result()
+        return self.executor
+
+    # Get the executor, starting it on first use when an app is imported instead of run
+    def get(self):
+        if self.executor is None:
+            self.start()
+        return self.executor
+
+    # Stop the workers, the next get() forks new ones
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    # Run function over items in chunks of chunk_size and return the per-item results in order.
+    # function takes a list of items and returns one result per item.
+    def map_chunks(self, function, items, chunk_size):
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        # map() yields chunk results in submission order, which keeps the sequencer order
+        return [result for chunk_results in self.get().map(function, chunks) for result in chunk_results]